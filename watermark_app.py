@@ -1,66 +1,71 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, colorchooser
-from PIL import Image, ImageDraw, ImageFont, ImageTk
+from PIL import ImageTk
 import os
+import queue
+
+from watermark_engine import WatermarkSettings, duplicate_outputs, find_available_font, iter_images
+from watermark_export import BackgroundExport
+from watermark_ingest import ImageIndex
+from watermark_listview import VirtualImageList
+from watermark_preview import PreviewScheduler, ProxyCache
+from watermark_viewport import ViewportRenderer, split_preview_budget
 
 
 class WatermarkApp:
-    def __init__(self):
+    def __init__(self, preview_cache_mb=256):
         self.window = tk.Tk()
         self.window.title("照片水印工具 - Mac版")
         self.window.geometry("900x700")
 
-        self.image_paths = []
+        self.image_paths = ImageIndex()  # 有序去重，大量图片时增删不需要逐项比较
         self.current_image_index = 0
         self.available_font = None
         self.watermark_color = "#FF0000"
+        self.logo_path = None  # 图片水印文件
         # 新增：记录当前预览图的原始尺寸和缩放比例
         self.current_original_size = None  # (原始宽, 原始高)
         self.current_scale_ratio = 1.0  # 当前缩放比例（相对于预览区域）
+        # 预览缩略图和视口瓦片共用一个内存上限（可配置）
+        proxy_bytes, tile_bytes = split_preview_budget(preview_cache_mb * 1024 * 1024)
+        self.proxy_cache = ProxyCache(proxy_bytes)
+        self.viewport_renderer = ViewportRenderer(self.proxy_cache, max_tile_bytes=tile_bytes)
+        self.view_center = (0.5, 0.5)  # 视口中心在图片中的相对位置（放大后可拖动平移）
+        self.pan_anchor = None
+        self.export_job = None  # 当前的后台导出任务
 
         # 初始化字体
         self.init_font()
 
         self.setup_ui()
+        self.preview_scheduler = PreviewScheduler(self.render_preview, self.on_preview_rendered,
+                                                  self.window.after, on_error=self.on_preview_error)
 
     def init_font(self):
         """初始化可用的字体"""
-        mac_fonts = [
-            "/System/Library/Fonts/PingFang.ttc",  # 苹方，支持中文
-            "/System/Library/Fonts/Helvetica.ttc",  # 系统默认
-            "/System/Library/Fonts/Arial.ttf",  # Arial
-        ]
-
-        for font_path in mac_fonts:
-            try:
-                if font_path.endswith('.ttc'):
-                    test_font = ImageFont.truetype(font_path, 20, index=0)
-                    self.available_font = font_path
-                    print(f"使用字体: {font_path}")
-                    break
-                else:
-                    test_font = ImageFont.truetype(font_path, 20)
-                    self.available_font = font_path
-                    print(f"使用字体: {font_path}")
-                    break
-            except:
-                continue
-
-        if not self.available_font:
-            print("警告: 使用默认字体")
-
-    def get_font(self, size):
-        """获取指定大小的字体"""
+        self.available_font = find_available_font(text="测试水印")
         if self.available_font:
-            try:
-                if self.available_font.endswith('.ttc'):
-                    return ImageFont.truetype(self.available_font, size, index=0)
-                else:
-                    return ImageFont.truetype(self.available_font, size)
-            except:
-                return ImageFont.load_default()
+            print(f"使用字体: {self.available_font[0]}")
         else:
-            return ImageFont.load_default()
+            print("警告: 使用默认字体")
+
+    def get_settings(self, watermark_text=None):
+        """从界面控件读取当前水印参数"""
+        return WatermarkSettings(
+            text=self.watermark_text.get() if watermark_text is None else watermark_text,
+            color=self.watermark_color,
+            font_size=self.font_size_var.get(),
+            opacity=self.opacity_scale.get(),
+            position=self.position_var.get(),
+            font_path=self.available_font[0] if self.available_font else None,
+            font_index=self.available_font[1] if self.available_font else 0,
+            layout="tiled" if self.tiled_var.get() else "single",
+            tile_angle=self.tile_angle_scale.get(),
+            tile_spacing=self.tile_spacing_scale.get(),
+            logo_path=self.logo_path,
+            logo_scale=self.logo_scale.get() / 100,
+            logo_position=self.logo_position_labels[self.logo_position_var.get()],
+        )
 
     def setup_ui(self):
         # 顶部按钮区域
@@ -71,7 +76,8 @@ class WatermarkApp:
         tk.Button(top_frame, text="选择文件夹", command=self.select_folder, width=15).pack(side=tk.LEFT, padx=5)
         tk.Button(top_frame, text="删除选中图片", command=self.delete_selected_images, width=15).pack(side=tk.LEFT,
                                                                                                       padx=5)
-        tk.Button(top_frame, text="导出图片", command=self.export_images, width=15).pack(side=tk.LEFT, padx=5)
+        self.export_button = tk.Button(top_frame, text="导出图片", command=self.export_images, width=15)
+        self.export_button.pack(side=tk.LEFT, padx=5)
 
         # 主内容区域
         main_frame = tk.Frame(self.window)
@@ -84,9 +90,13 @@ class WatermarkApp:
 
         tk.Label(left_frame, text="图片列表", font=("Arial", 12, "bold")).pack(pady=5)
 
-        self.image_listbox = tk.Listbox(left_frame, selectbackground="#4a86e8", selectforeground="white")
+        self.recursive_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(left_frame, text="包含子文件夹", variable=self.recursive_var).pack(anchor=tk.W)
+
+        # 只渲染可见行，上万张图片时滚动和刷新依然流畅
+        self.image_listbox = VirtualImageList(left_frame, self.image_paths, on_select=self.on_image_select,
+                                              selectbackground="#4a86e8", selectforeground="white")
         self.image_listbox.pack(fill=tk.BOTH, expand=True)
-        self.image_listbox.bind('<<ListboxSelect>>', self.on_image_select)
 
         # 右侧预览和设置
         right_frame = tk.Frame(main_frame)
@@ -159,25 +169,78 @@ class WatermarkApp:
             rb = tk.Radiobutton(pos_frame, text=text, variable=self.position_var, value=value)
             rb.grid(row=i // 3, column=i % 3, sticky='w', padx=5)
 
+        # 平铺模式（倾斜重复铺满整张图片）
+        tk.Label(settings_frame, text="平铺:").grid(row=3, column=0, sticky='w', pady=5)
+        tile_frame = tk.Frame(settings_frame)
+        tile_frame.grid(row=3, column=1, columnspan=4, sticky='w', pady=5)
+        self.tiled_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(tile_frame, text="倾斜平铺", variable=self.tiled_var,
+                       command=self.on_settings_change).pack(side=tk.LEFT)
+        tk.Label(tile_frame, text="角度:").pack(side=tk.LEFT, padx=(10, 0))
+        self.tile_angle_scale = tk.Scale(tile_frame, from_=-90, to=90, orient=tk.HORIZONTAL, length=120,
+                                         command=self.on_settings_change)
+        self.tile_angle_scale.set(30)
+        self.tile_angle_scale.pack(side=tk.LEFT)
+        tk.Label(tile_frame, text="间距:").pack(side=tk.LEFT, padx=(10, 0))
+        self.tile_spacing_scale = tk.Scale(tile_frame, from_=0, to=400, orient=tk.HORIZONTAL, length=120,
+                                           command=self.on_settings_change)
+        self.tile_spacing_scale.set(80)
+        self.tile_spacing_scale.pack(side=tk.LEFT)
+
+        # 图片水印（Logo）
+        tk.Label(settings_frame, text="图片水印:").grid(row=4, column=0, sticky='w', pady=5)
+        logo_frame = tk.Frame(settings_frame)
+        logo_frame.grid(row=4, column=1, columnspan=4, sticky='w', pady=5)
+        tk.Button(logo_frame, text="选择图片", command=self.choose_logo, width=8).pack(side=tk.LEFT)
+        tk.Button(logo_frame, text="清除", command=self.clear_logo, width=5).pack(side=tk.LEFT, padx=3)
+        self.logo_label = tk.Label(logo_frame, text="未选择", width=14, anchor='w')
+        self.logo_label.pack(side=tk.LEFT)
+        tk.Label(logo_frame, text="大小%:").pack(side=tk.LEFT)
+        self.logo_scale = tk.Scale(logo_frame, from_=5, to=60, orient=tk.HORIZONTAL, length=100,
+                                   command=self.on_settings_change)
+        self.logo_scale.set(15)
+        self.logo_scale.pack(side=tk.LEFT)
+        self.logo_position_labels = {text: value for text, value in positions}
+        self.logo_position_var = tk.StringVar(value="左下")
+        tk.OptionMenu(logo_frame, self.logo_position_var, *self.logo_position_labels).pack(side=tk.LEFT, padx=5)
+
         # 事件绑定
         self.watermark_text.bind('<KeyRelease>', self.on_settings_change)
+        self.logo_position_var.trace('w', self.on_settings_change)
         self.opacity_scale.configure(command=self.on_settings_change)
         self.position_var.trace('w', self.on_settings_change)
         self.font_size_scale.configure(command=self.on_settings_change)
         # 监听预览容器大小变化，自动调整图片位置
         preview_container.bind("<Configure>", self.on_preview_container_resize)
+        # 放大后按住鼠标左键拖动平移
+        self.preview_canvas.bind("<ButtonPress-1>", self.on_pan_start)
+        self.preview_canvas.bind("<B1-Motion>", self.on_pan_move)
+        self.preview_canvas.bind("<ButtonRelease-1>", self.on_pan_end)
 
         # 更新按钮
         tk.Button(settings_frame, text="更新预览", command=self.force_update_preview,
-                  bg='lightblue').grid(row=3, column=0, columnspan=5, pady=10)
+                  bg='lightblue').grid(row=5, column=0, columnspan=5, pady=10)
 
         # 状态栏
         self.status_label = tk.Label(self.window, text="就绪", bd=1, relief=tk.SUNKEN, anchor=tk.W)
         self.status_label.pack(fill=tk.X, side=tk.BOTTOM)
 
+        # 导出进度（后台导出，可暂停/取消）
+        export_frame = tk.Frame(self.window)
+        export_frame.pack(fill=tk.X, side=tk.BOTTOM, padx=10, pady=(0, 5))
+        self.export_progress = ttk.Progressbar(export_frame, orient=tk.HORIZONTAL, mode='determinate')
+        self.export_progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        self.pause_button = tk.Button(export_frame, text="暂停", command=self.toggle_pause_export, width=8,
+                                      state=tk.DISABLED)
+        self.pause_button.pack(side=tk.LEFT, padx=3)
+        self.cancel_button = tk.Button(export_frame, text="取消", command=self.cancel_export, width=8,
+                                       state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=3)
+
     def on_settings_change(self, *args):
+        # 预览调度器会合并连续的请求，只渲染最新的设置
         if self.image_paths and self.current_image_index is not None:
-            self.window.after(100, lambda: self.show_preview(self.current_image_index))
+            self.show_preview(self.current_image_index)
 
     def force_update_preview(self):
         if self.image_paths and self.current_image_index is not None:
@@ -189,8 +252,7 @@ class WatermarkApp:
     def select_images(self):
         files = filedialog.askopenfilenames(filetypes=[("图片文件", "*.jpg *.jpeg *.png *.bmp *.tiff")])
         if files:
-            new_files = [f for f in files if f not in self.image_paths]
-            self.image_paths.extend(new_files)
+            self.image_paths.add_many(files)
             self.update_image_list()
             if self.image_paths:
                 self.reset_zoom()  # 重置缩放比例
@@ -200,13 +262,7 @@ class WatermarkApp:
     def select_folder(self):
         folder = filedialog.askdirectory(title="选择图片文件夹")
         if folder:
-            image_files = []
-            for ext in ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff']:
-                ext_files = [os.path.join(folder, f) for f in os.listdir(folder)
-                             if f.lower().endswith(ext[1:])]
-                image_files.extend(ext_files)
-            new_files = [f for f in image_files if f not in self.image_paths]
-            self.image_paths.extend(new_files)
+            self.image_paths.add_many(iter_images(folder, recursive=self.recursive_var.get()))
             self.update_image_list()
             if self.image_paths:
                 self.reset_zoom()  # 重置缩放比例
@@ -214,16 +270,11 @@ class WatermarkApp:
                 self.update_status(f"已选择文件夹内 {len(self.image_paths)} 张图片")
 
     def update_image_list(self):
-        self.image_listbox.delete(0, tk.END)
-        for idx, path in enumerate(self.image_paths):
-            filename = os.path.basename(path)
-            self.image_listbox.insert(tk.END, f"{idx + 1}. {filename}")
+        self.image_listbox.refresh()
 
-    def on_image_select(self, event):
-        selection = self.image_listbox.curselection()
-        if selection:
-            self.reset_zoom()  # 切换图片时重置缩放比例
-            self.show_preview(selection[0])
+    def on_image_select(self, index):
+        self.reset_zoom()  # 切换图片时重置缩放比例
+        self.show_preview(index)
 
     def choose_watermark_color(self):
         color = colorchooser.askcolor(title="选择水印颜色", initialcolor=self.watermark_color)
@@ -232,14 +283,27 @@ class WatermarkApp:
             self.color_preview.config(bg=self.watermark_color)
             self.on_settings_change()
 
+    def choose_logo(self):
+        path = filedialog.askopenfilename(title="选择图片水印", filetypes=[("图片文件", "*.png *.webp *.gif *.jpg *.jpeg")])
+        if path:
+            self.logo_path = path
+            self.logo_label.config(text=os.path.basename(path))
+            self.on_settings_change()
+
+    def clear_logo(self):
+        self.logo_path = None
+        self.logo_label.config(text="未选择")
+        self.on_settings_change()
+
     def delete_selected_images(self):
         selections = self.image_listbox.curselection()
         if not selections:
             messagebox.showwarning("警告", "请先在图片列表中选择要删除的图片")
             return
 
-        for idx in reversed(selections):
-            del self.image_paths[idx]
+        for path in self.image_paths.remove_indices(selections):
+            self.proxy_cache.discard(path)
+        self.image_listbox.clear_selection()
 
         self.update_image_list()
         if self.image_paths:
@@ -286,20 +350,13 @@ class WatermarkApp:
             )
             return
 
-        # 获取图片原始尺寸和预览容器尺寸
-        img_width, img_height = image.size
+        # image 是视口渲染器输出的画布大小的图片，只需居中放置（画布尺寸变化期间可能略有差异）
         container_width, container_height = self.get_preview_container_size()
-
-        # 计算缩放后的图片尺寸
-        scaled_width = int(img_width * self.current_scale_ratio)
-        scaled_height = int(img_height * self.current_scale_ratio)
-
-        # 计算图片居中坐标（关键：基于容器中心和图片中心对齐，避免偏移）
-        x = (container_width - scaled_width) // 2  # 水平居中
-        y = (container_height - scaled_height) // 2  # 垂直居中
+        x = (container_width - image.width) // 2  # 水平居中
+        y = (container_height - image.height) // 2  # 垂直居中
 
         # 转换为Tkinter可用格式并显示
-        self.tk_image = ImageTk.PhotoImage(image.resize((scaled_width, scaled_height), Image.Resampling.LANCZOS))
+        self.tk_image = ImageTk.PhotoImage(image)
         self.preview_canvas.create_image(x, y, anchor=tk.NW, image=self.tk_image, tags="preview_img")
 
     def on_preview_container_resize(self, event):
@@ -313,6 +370,26 @@ class WatermarkApp:
             # 重新加载并显示图片
             self.show_preview(self.current_image_index)
 
+    def on_pan_start(self, event):
+        self.pan_anchor = (event.x, event.y)
+
+    def on_pan_move(self, event):
+        """拖动平移：移动视口中心，只有新露出的瓦片需要重新生成"""
+        if not self.pan_anchor or not self.current_original_size or self.current_image_index is None:
+            return
+        dx, dy = event.x - self.pan_anchor[0], event.y - self.pan_anchor[1]
+        self.pan_anchor = (event.x, event.y)
+        display_width = self.current_original_size[0] * self.current_scale_ratio
+        display_height = self.current_original_size[1] * self.current_scale_ratio
+        center_x = min(1.0, max(0.0, self.view_center[0] - dx / display_width))
+        center_y = min(1.0, max(0.0, self.view_center[1] - dy / display_height))
+        if (center_x, center_y) != self.view_center:
+            self.view_center = (center_x, center_y)
+            self.show_preview(self.current_image_index)
+
+    def on_pan_end(self, event):
+        self.pan_anchor = None
+
     def zoom_in(self):
         """放大图片（原位置放大，每次增加20%比例）"""
         if not self.current_original_size or not self.image_paths:
@@ -340,6 +417,7 @@ class WatermarkApp:
 
     def reset_zoom(self):
         """重置图片大小为初始适配尺寸"""
+        self.view_center = (0.5, 0.5)
         if self.current_original_size:
             container_width, container_height = self.get_preview_container_size()
             self.current_scale_ratio = self.calculate_initial_scale(
@@ -353,148 +431,138 @@ class WatermarkApp:
     # -------------------------------------------------------------------
 
     def show_preview(self, index):
+        """提交预览任务：主线程只读取控件状态，解码和叠加水印在后台线程进行"""
         try:
             self.current_image_index = index
             image_path = self.image_paths[index]
 
-            # 加载原图并记录原始尺寸（用于缩放计算）
-            original_image = Image.open(image_path)
-            self.current_original_size = original_image.size  # 保存原始尺寸
-            img_width, img_height = original_image.size
-
-            # 添加水印（预览时字体大小按缩放比例调整，确保水印与图片比例一致）
-            watermark_text = self.watermark_text.get()
-            if watermark_text:
-                # 预览水印字体大小 = 导出字体大小 * 当前缩放比例（保持视觉一致）
-                preview_font_size = int(self.font_size_var.get() * self.current_scale_ratio)
-                preview_image = self.add_watermark_to_image(original_image, watermark_text, preview=True,
-                                                            preview_font_size=preview_font_size)
-            else:
-                preview_image = original_image.copy()
-
-            # 更新预览图片（核心：居中显示，无偏移）
-            self.update_preview_image(preview_image)
-
-            # 更新状态栏
-            filename = os.path.basename(image_path)
-            scale_percent = int(self.current_scale_ratio * 100)
-            self.update_status(
-                f"正在预览: {filename} (共{len(self.image_paths)}张，当前第{index + 1}张，缩放{scale_percent}%)")
-
+            # 记录原始尺寸（只读文件头，用于缩放计算）
+            self.current_original_size = self.proxy_cache.original_size(image_path)
         except Exception as e:
             messagebox.showerror("错误", f"无法加载图片: {str(e)}")
+            return
 
-    def add_watermark_to_image(self, image, watermark_text, preview=False, preview_font_size=None):
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-
-        watermark_layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark_layer)
-
-        # 确定字体大小（预览用调整后的大小，导出用设置大小）
-        if preview and preview_font_size:
-            font_size = preview_font_size
-        else:
-            font_size = self.font_size_var.get()
-
-        font = self.get_font(font_size)
-
-        # 计算水印位置（基于原始图片尺寸，确保位置准确）
-        position = self.calculate_position(image.size, draw, watermark_text, font)
-
-        # 转换颜色（十六进制转RGB）
-        r = int(self.watermark_color[1:3], 16)
-        g = int(self.watermark_color[3:5], 16)
-        b = int(self.watermark_color[5:7], 16)
-        opacity = int(255 * (self.opacity_scale.get() / 100))
-
-        # 绘制水印文字
-        draw.text(position, watermark_text, font=font, fill=(r, g, b, opacity))
-
-        # 合并图层
-        watermarked = Image.alpha_composite(image, watermark_layer)
-        return watermarked
+        self.preview_scheduler.request({
+            "index": index,
+            "path": image_path,
+            "settings": self.get_settings(),
+            "scale": self.current_scale_ratio,
+            "center": self.view_center,
+            "canvas_size": self.get_preview_container_size(),
+        })
+
+    def render_preview(self, job):
+        """后台线程：只渲染画布可见区域的瓦片并叠加水印（不访问任何 Tk 控件）"""
+        return self.viewport_renderer.render(job["path"], job["scale"], job["center"], job["canvas_size"],
+                                             settings=job["settings"])
+
+    def on_preview_rendered(self, job, preview_image):
+        """主线程：把渲染好的预览图放到画布上"""
+        if job["index"] != self.current_image_index or not self.image_paths:
+            return
+        # 更新预览图片（核心：居中显示，无偏移）
+        self.update_preview_image(preview_image)
 
-    def calculate_position(self, image_size, draw, text, font):
-        width, height = image_size
+        # 更新状态栏
+        filename = os.path.basename(job["path"])
+        scale_percent = int(job["scale"] * 100)
+        self.update_status(
+            f"正在预览: {filename} (共{len(self.image_paths)}张，当前第{job['index'] + 1}张，缩放{scale_percent}%)")
 
-        # 精确计算文字尺寸
-        try:
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-        except:
-            text_width = len(text) * font.size * 0.5
-            text_height = font.size * 1.2
-
-        # 动态边距（避免水印贴边）
-        margin = min(width, height) * 0.02
-        if margin < 10:
-            margin = 10
-
-        # 位置映射（基于原始图片尺寸计算，确保位置准确）
-        position_map = {
-            "top-left": (margin, margin),
-            "top-center": ((width - text_width) // 2, margin),
-            "top-right": (width - text_width - margin, margin),
-            "middle-left": (margin, (height - text_height) // 2),
-            "center": ((width - text_width) // 2, (height - text_height) // 2),
-            "middle-right": (width - text_width - margin, (height - text_height) // 2),
-            "bottom-left": (margin, height - text_height - margin),
-            "bottom-center": ((width - text_width) // 2, height - text_height - margin),
-            "bottom-right": (width - text_width - margin, height - text_height - margin)
-        }
-
-        return position_map[self.position_var.get()]
+    def on_preview_error(self, job, error):
+        messagebox.showerror("错误", f"无法加载图片: {str(error)}")
 
     def export_images(self):
+        if self.export_job is not None and self.export_job.is_alive():
+            return
         if not self.image_paths:
             messagebox.showwarning("警告", "请先选择图片")
             return
         watermark_text = self.watermark_text.get().strip()
-        if not watermark_text:
-            messagebox.showwarning("警告", "请输入水印文字")
+        if not watermark_text and not self.logo_path:
+            messagebox.showwarning("警告", "请输入水印文字或选择图片水印")
+            return
+        duplicates = duplicate_outputs(self.image_paths)
+        if duplicates:
+            # 不同文件夹中的同名图片会写到同一个输出文件
+            names = "\n".join(f"{name}: {len(sources)} 张" for name, sources in list(duplicates.items())[:10])
+            messagebox.showerror("错误", f"以下输出文件名对应多张图片，导出后会互相覆盖，请先从列表中移除重名的图片:\n{names}")
             return
         output_dir = filedialog.askdirectory(title="选择输出文件夹")
         if not output_dir:
             return
 
-        try:
-            success_count = 0
-            total = len(self.image_paths)
-            for i, image_path in enumerate(self.image_paths, 1):
-                if self.process_single_image(image_path, output_dir, watermark_text):
-                    success_count += 1
-                self.update_status(f"正在导出: {i}/{total} (成功{success_count}张)")
-                self.window.update()
-
-            messagebox.showinfo("完成", f"导出完成！\n成功处理 {success_count}/{total} 张图片\n输出路径: {output_dir}")
-            self.update_status(f"导出完成，成功{success_count}张，失败{total - success_count}张")
-
-        except Exception as e:
-            messagebox.showerror("错误", f"批量处理失败: {str(e)}")
-            self.update_status(f"导出失败: {str(e)}")
-
-    def process_single_image(self, image_path, output_dir, watermark_text):
-        try:
-            original = Image.open(image_path)
-            watermarked = self.add_watermark_to_image(original, watermark_text, preview=False)
-
-            filename = os.path.basename(image_path)
-            name, ext = os.path.splitext(filename)
-            output_filename = f"watermarked_{name}{ext}"
-            output_path = os.path.join(output_dir, output_filename)
-
-            # 按格式保存
-            if ext.lower() in ['.png']:
-                watermarked.save(output_path, "PNG", compress_level=6)
+        # 导出在后台进行，主线程只轮询进度队列
+        # 同一台相机的照片尺寸相同，按尺寸复用合成计划（结果与逐张合成相同）
+        self.export_job = BackgroundExport(self.image_paths, output_dir, self.get_settings(watermark_text),
+                                           batch=True).start()
+        self.export_output_dir = output_dir
+        self.export_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.NORMAL, text="暂停")
+        self.cancel_button.config(state=tk.NORMAL)
+        self.export_progress.config(maximum=len(self.image_paths), value=0)
+        self.update_status("正在准备导出...")
+        self.window.after(100, self.poll_export)
+
+    def poll_export(self):
+        """主线程定时读取导出进度"""
+        final = None
+        while True:
+            try:
+                kind, data = self.export_job.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.show_export_progress(data)
             else:
-                watermarked.convert("RGB").save(output_path, "JPEG", quality=95)
+                final = (kind, data)
+        if final is None:
+            self.window.after(100, self.poll_export)
+            return
 
-            return True
-        except Exception as e:
-            print(f"处理图片 {os.path.basename(image_path)} 时出错: {str(e)}")
-            return False
+        self.export_button.config(state=tk.NORMAL)
+        self.pause_button.config(state=tk.DISABLED, text="暂停")
+        self.cancel_button.config(state=tk.DISABLED)
+        kind, data = final
+        if kind == "error":
+            messagebox.showerror("错误", f"批量处理失败: {data}")
+            self.update_status(f"导出失败: {data}")
+            return
+        self.show_export_progress(data)
+        if kind == "cancelled":
+            self.update_status(f"导出已取消，已完成{data['done']}/{data['total']}张（再次导出会从断点继续）")
+            return
+        messagebox.showinfo("完成", f"导出完成！\n成功处理 {data['success']}/{data['total']} 张图片"
+                                  f"（其中 {data['skipped']} 张未变化已跳过）\n输出路径: {self.export_output_dir}")
+        self.update_status(f"导出完成，成功{data['success']}张，失败{data['failed']}张，"
+                           f"平均 {data['images_per_second']} 张/秒")
+
+    def show_export_progress(self, stats):
+        self.export_progress.config(value=stats["done"])
+        eta = f"，剩余约{int(stats['eta_seconds'])}秒" if stats["eta_seconds"] is not None else ""
+        paused = "（已暂停）" if self.export_job.paused else ""
+        self.update_status(
+            f"正在导出{paused}: {stats['done']}/{stats['total']} (成功{stats['success']}张，跳过{stats['skipped']}张，"
+            f"失败{stats['failed']}张) {stats['images_per_second']} 张/秒，{stats['mb_per_second']} MB/秒{eta}")
+
+    def toggle_pause_export(self):
+        if self.export_job is None or not self.export_job.is_alive():
+            return
+        if self.export_job.paused:
+            self.export_job.resume()
+            self.pause_button.config(text="暂停")
+            self.update_status("继续导出...")
+        else:
+            self.export_job.pause()
+            self.pause_button.config(text="继续")
+            self.update_status("正在暂停（处理中的图片完成后停止）...")
+
+    def cancel_export(self):
+        if self.export_job is not None and self.export_job.is_alive():
+            self.export_job.cancel()
+            self.cancel_button.config(state=tk.DISABLED)
+            self.pause_button.config(state=tk.DISABLED)
+            self.update_status("正在取消（处理中的图片完成后停止）...")
 
     def run(self):
         self.window.mainloop()
@@ -0,0 +1,314 @@
+"""渲染/导出管线基准测试（完全离线运行）
+
+生成不同分辨率的合成 JPEG/PNG/TIFF 图片，分别计时解码、水印栅格化、合成、编码，
+以及单张导出和预览渲染的整体耗时；结果（吞吐、延迟分位数、峰值内存）保存为 JSON，
+并可与之前保存的基线比较，标出变慢的项目。
+
+示例:
+    python watermark_bench.py --sizes 1,4,12 -o bench.json
+    python watermark_bench.py --sizes 1,4,12 --baseline bench.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import PIL
+from PIL import Image
+
+from watermark_batch import add_watermark_batched
+from watermark_engine import (POSITIONS, WatermarkSettings, add_watermark_to_image, find_available_font,
+                              normalize_mode, output_path_for, render_stamp, save_image, stamp_for, watermark_file)
+from watermark_preview import ProxyCache
+from watermark_viewport import ViewportRenderer
+
+FORMATS = {"jpeg": ".jpg", "png": ".png", "tiff": ".tif"}
+DEFAULT_SIZES = (1, 4, 12, 24)
+ALL_SIZES = (1, 4, 12, 24, 50, 100)
+DEFAULT_OPACITIES = (30, 70, 100)
+PREVIEW_CANVAS = (660, 440)
+
+# 低于这个差值（毫秒）的变化视为噪声，不算退化
+NOISE_FLOOR_MS = 0.5
+
+
+def image_dimensions(megapixels):
+    """3:2 画幅下给定百万像素数的宽高"""
+    width = round(math.sqrt(megapixels * 1_000_000 * 1.5))
+    return width, round(width / 1.5)
+
+
+def synthetic_image(size):
+    """渐变叠加噪声的合成图片（不会被编码器过度压缩，接近真实照片的编码开销）"""
+    noise = Image.effect_noise(size, 48)
+    horizontal = Image.linear_gradient("L").resize(size)
+    vertical = Image.linear_gradient("L").rotate(90).resize(size)
+    return Image.merge("RGB", (Image.blend(horizontal, noise, 0.35), Image.blend(vertical, noise, 0.35), noise))
+
+
+def ensure_corpus(corpus_dir, sizes, formats):
+    """生成（或复用已有的）合成图片，返回 {(格式, 百万像素): 路径}"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = {}
+    for megapixels in sizes:
+        image = None
+        for name in formats:
+            path = os.path.join(corpus_dir, f"synthetic_{megapixels}mp{FORMATS[name]}")
+            if not os.path.exists(path):
+                if image is None:
+                    image = synthetic_image(image_dimensions(megapixels))
+                tmp_path = f"{path}.tmp"
+                if name == "jpeg":
+                    image.save(tmp_path, "JPEG", quality=90)
+                elif name == "png":
+                    image.save(tmp_path, "PNG", compress_level=1)
+                else:
+                    image.save(tmp_path, "TIFF")
+                os.replace(tmp_path, path)
+            corpus[(name, megapixels)] = path
+    return corpus
+
+
+def percentiles(samples):
+    """延迟统计（毫秒）"""
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p90_ms": round(pick(0.90) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def stage_result(samples, megapixels):
+    result = percentiles(samples)
+    total = sum(samples)
+    result["per_second"] = round(len(samples) / total, 2) if total > 0 else None
+    result["megapixels_per_second"] = round(len(samples) * megapixels / total, 2) if total > 0 else None
+    return result
+
+
+def peak_rss_mb():
+    """进程的峰值常驻内存（MB）
+
+    优先读 /proc 中的 VmHWM：它在 exec 时清零，而 ru_maxrss 会带上 spawn 之前父进程的峰值。
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # Linux 上 ru_maxrss 的单位是 KB（macOS 上是字节）
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+
+def decode(path):
+    with Image.open(path) as image:
+        image.load()
+        return normalize_mode(image)
+
+
+def bench_case(path, megapixels, settings, opacities, repeat, output_dir):
+    """在独立的进程中测一个 (格式, 分辨率) 组合，峰值内存只反映这一组合"""
+    stages = {name: [] for name in ("decode", "stamp", "composite", "composite_batch", "composite_tiled",
+                                          "composite_tiled_batch", "encode", "export", "preview")}
+
+    image = None
+    for _ in range(repeat):
+        seconds, image = timed(decode, path)
+        stages["decode"].append(seconds)
+
+    # 每种位置 x 透明度组合：冷缓存栅格化水印，再在同一张图上原位合成
+    for position in POSITIONS:
+        for opacity in opacities:
+            variant = settings.with_changes(position=position, opacity=opacity)
+            render_stamp.cache_clear()
+            stages["stamp"].append(timed(stamp_for, variant)[0])
+            for _ in range(repeat):
+                stages["composite"].append(timed(add_watermark_to_image, image, variant, inplace=True)[0])
+            # 批量合成：第一次生成合成计划，之后同尺寸的图片直接复用
+            add_watermark_batched(image, variant, inplace=True)
+            for _ in range(repeat):
+                stages["composite_batch"].append(timed(add_watermark_batched, image, variant, inplace=True)[0])
+
+    tiled = settings.with_changes(layout="tiled")
+    add_watermark_batched(image, tiled, inplace=True)
+    for _ in range(repeat):
+        stages["composite_tiled"].append(timed(add_watermark_to_image, image, tiled, inplace=True)[0])
+        stages["composite_tiled_batch"].append(timed(add_watermark_batched, image, tiled, inplace=True)[0])
+
+    for _ in range(repeat):
+        stages["encode"].append(timed(save_image, image, output_path_for(path, output_dir))[0])
+    del image
+
+    for _ in range(repeat):
+        stages["export"].append(timed(watermark_file, path, output_dir, settings)[0])
+
+    # 预览：首次包含缩小解码，之后命中缩略图缓存、只重新拼接瓦片和叠加水印
+    renderer = ViewportRenderer(ProxyCache())
+    width, height = renderer.pyramid(path).original_size
+    scale = min(PREVIEW_CANVAS[0] / width, PREVIEW_CANVAS[1] / height, 1.0)
+    preview_cold = timed(renderer.render, path, scale, (0.5, 0.5), PREVIEW_CANVAS, settings)[0]
+    for _ in range(repeat):
+        stages["preview"].append(timed(renderer.render, path, scale, (0.5, 0.5), PREVIEW_CANVAS, settings)[0])
+
+    result = {name: stage_result(samples, megapixels) for name, samples in stages.items()}
+    result["preview"]["cold_ms"] = round(preview_cold * 1000, 3)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_benchmarks(corpus, settings, opacities, repeat, output_dir, progress=None):
+    """每个组合用一个新进程运行（spawn，避免继承之前组合的内存峰值）"""
+    results = {}
+    context = get_context("spawn")
+    for (name, megapixels), path in sorted(corpus.items(), key=lambda item: (item[0][1], item[0][0])):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            case = executor.submit(bench_case, path, megapixels, settings, opacities, repeat, output_dir).result()
+        case["file_bytes"] = os.path.getsize(path)
+        results[f"{name}/{megapixels}mp"] = case
+        if progress:
+            progress(name, megapixels, case)
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """与基线比较各阶段的 p50 延迟，返回变慢超过 threshold（比例）的项目"""
+    regressions = []
+    for case, stages in results.items():
+        base_stages = baseline.get("results", {}).get(case)
+        if not base_stages:
+            continue
+        for stage, stats in stages.items():
+            if not isinstance(stats, dict) or stage not in base_stages:
+                continue
+            current, previous = stats["p50_ms"], base_stages[stage]["p50_ms"]
+            if current > previous * (1 + threshold) and current - previous > NOISE_FLOOR_MS:
+                regressions.append({
+                    "case": case,
+                    "stage": stage,
+                    "baseline_p50_ms": previous,
+                    "current_p50_ms": current,
+                    "change": round(current / previous - 1, 3) if previous else None,
+                })
+    return regressions
+
+
+def parse_list(value, convert):
+    return tuple(convert(item) for item in value.split(",") if item)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="水印渲染/导出管线基准测试")
+    parser.add_argument("--sizes", type=lambda v: parse_list(v, float), default=DEFAULT_SIZES,
+                        help="图片尺寸（百万像素，逗号分隔，默认 1,4,12,24；--full 为 1 到 100）")
+    parser.add_argument("--full", action="store_true", help="测试全部尺寸 1,4,12,24,50,100")
+    parser.add_argument("--formats", type=lambda v: parse_list(v, str), default=tuple(FORMATS),
+                        help="图片格式（jpeg,png,tiff）")
+    parser.add_argument("--opacities", type=lambda v: parse_list(v, int), default=DEFAULT_OPACITIES,
+                        help="透明度（逗号分隔），与 9 个位置组合测试")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数")
+    parser.add_argument("--text", default="测试水印", help="水印文字")
+    parser.add_argument("--font-size", type=int, default=48)
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "watermark_bench_corpus"),
+                        help="合成图片目录（已存在的图片会复用）")
+    parser.add_argument("-o", "--output", help="保存结果的 JSON 文件")
+    parser.add_argument("--baseline", help="基线结果 JSON，变慢超过阈值时返回码为 1")
+    parser.add_argument("--threshold", type=float, default=0.25, help="退化阈值（比例，默认 0.25 即慢 25%%）")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sizes = ALL_SIZES if args.full else args.sizes
+    sizes = tuple(int(s) if float(s).is_integer() else s for s in sizes)
+    unknown = [name for name in args.formats if name not in FORMATS]
+    if unknown:
+        print(f"不支持的格式: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    font = find_available_font(text=args.text)
+    settings = WatermarkSettings(text=args.text, font_size=args.font_size,
+                                 font_path=font[0] if font else None, font_index=font[1] if font else 0)
+
+    print(f"准备合成图片: {args.corpus_dir}", file=sys.stderr)
+    corpus = ensure_corpus(args.corpus_dir, sizes, args.formats)
+
+    def progress(name, megapixels, case):
+        print(f"{name:>5} {megapixels:>4}MP  解码 {case['decode']['p50_ms']:9.1f}ms  "
+              f"水印 {case['stamp']['p50_ms']:7.2f}ms  合成 {case['composite']['p50_ms']:7.2f}ms  "
+              f"平铺合成 {case['composite_tiled']['p50_ms']:7.2f}/{case['composite_tiled_batch']['p50_ms']:.2f}ms  "
+              f"编码 {case['encode']['p50_ms']:9.1f}ms  导出 {case['export']['p50_ms']:9.1f}ms  "
+              f"预览 {case['preview']['p50_ms']:7.1f}ms  峰值内存 {case['peak_rss_mb']:7.1f}MB", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        results = run_benchmarks(corpus, settings, args.opacities, args.repeat, output_dir, progress)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(),
+        "config": {"sizes": list(sizes), "formats": list(args.formats), "opacities": list(args.opacities),
+                   "positions": list(POSITIONS), "repeat": args.repeat, "text": args.text,
+                   "font_size": args.font_size, "font": font[0] if font else None},
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+        for item in regressions:
+            # 基线为 0 时没有变化比例
+            change = f" (+{item['change']:.0%})" if item["change"] is not None else ""
+            print(f"变慢: {item['case']} {item['stage']} p50 {item['baseline_p50_ms']}ms -> "
+                  f"{item['current_p50_ms']}ms{change}", file=sys.stderr)
+        if regressions:
+            exit_code = 1
+        else:
+            print("与基线相比没有明显变慢", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,442 @@
+"""命令行批量水印工具（无需图形界面，可在服务器上运行）
+
+示例:
+    python watermark_cli.py export ./photos -o ./out --text "© 2024" --workers 16
+    python watermark_cli.py variants ./photos -o ./out --job job.json
+    python watermark_cli.py shard /mnt/photos -o /mnt/out --lease      # 每台机器各运行一次
+    python watermark_cli.py shard-merge /mnt/out --inputs /mnt/photos
+    python watermark_cli.py watch ./inbox -o ./out --text "© 2024"
+    python watermark_cli.py serve --port 8765 --text "© 2024"
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from watermark_batch import group_by_size
+from watermark_engine import (IMAGE_EXTENSIONS, LAYOUTS, POSITIONS, WatermarkSettings, duplicate_outputs,
+                              find_available_font, iter_images)
+from watermark_export import run_export, skipped_result, summarize
+from watermark_fonts import default_font_index, needed_scripts
+from watermark_manifest import ExportManifest, settings_hash
+from watermark_metrics import metrics
+from watermark_pipeline import DEFAULT_IO_THREADS, ExportPipeline
+from watermark_server import DEFAULT_HOST, DEFAULT_MAX_QUEUE, DEFAULT_PORT, WatermarkService, serve
+from watermark_shard import (DEFAULT_LEASE_TTL, ShardedExport, merge_reports, parse_shard,
+                             record_in_manifest)
+from watermark_variants import duplicate_variant_outputs, load_job, run_variants
+from watermark_watch import (DEFAULT_BATCH_WINDOW, DEFAULT_MAX_BATCH, DEFAULT_POLL_INTERVAL, DEFAULT_SETTLE,
+                             FolderWatcher, run_until_signalled)
+
+
+def collect_inputs(inputs, recursive=False):
+    """展开命令行输入（文件或文件夹），按出现顺序去重"""
+    paths = []
+    seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = iter_images(item, recursive)
+        elif item.lower().endswith(IMAGE_EXTENSIONS):
+            candidates = [item]
+        else:
+            print(f"跳过不支持的文件: {item}", file=sys.stderr)
+            continue
+        for path in candidates:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def check_output_names(duplicates):
+    """输出文件名冲突（不同文件夹中的同名图片）时打印冲突的文件并返回 False"""
+    if not duplicates:
+        return True
+    print(f"有 {len(duplicates)} 个输出文件名对应多张图片，导出后会互相覆盖，请重命名或分开导出:", file=sys.stderr)
+    for name, sources in list(duplicates.items())[:20]:
+        print(f"  {name}: {', '.join(sources)}", file=sys.stderr)
+    return False
+
+
+def resolve_font(font, font_index, text):
+    """--font 可以是字体文件路径或字体族名；未指定时自动查找能显示水印文字的字体"""
+    if font and os.path.isfile(font):
+        return font, font_index
+    found = find_available_font(text=text, family=font)
+    if found is None:
+        if font:
+            raise SystemExit(f"找不到字体: {font}")
+        print("警告: 使用默认字体", file=sys.stderr)
+        return None, 0
+    return found
+
+
+def settings_from_args(args):
+    font_path, font_index = resolve_font(args.font, args.font_index, args.text)
+    return WatermarkSettings(
+        text=args.text,
+        color=args.color,
+        font_size=args.font_size,
+        opacity=args.opacity,
+        position=args.position,
+        font_path=font_path,
+        font_index=font_index,
+        layout=args.layout,
+        tile_angle=args.tile_angle,
+        tile_spacing=args.tile_spacing,
+        tile_stagger=args.tile_stagger,
+        logo_path=args.logo,
+        logo_scale=args.logo_scale,
+        logo_position=args.logo_position,
+    )
+
+
+def add_settings_arguments(parser):
+    """水印参数（各子命令共用）"""
+    defaults = WatermarkSettings()
+    parser.add_argument("--text", default=defaults.text, help="水印文字")
+    parser.add_argument("--color", default=defaults.color, help="水印颜色，如 #FF0000")
+    parser.add_argument("--font-size", type=int, default=defaults.font_size, help="字体大小")
+    parser.add_argument("--opacity", type=int, default=defaults.opacity, help="透明度 0-100")
+    parser.add_argument("--position", choices=POSITIONS, default=defaults.position, help="水印位置")
+    parser.add_argument("--font", help="字体文件路径或字体族名（默认自动查找能显示水印文字的字体）")
+    parser.add_argument("--font-index", type=int, default=0, help=".ttc 字体集中的序号")
+    parser.add_argument("--layout", choices=LAYOUTS, default=defaults.layout,
+                        help="single：单个水印；tiled：倾斜平铺满整张图片（忽略 --position）")
+    parser.add_argument("--tile-angle", type=float, default=defaults.tile_angle, help="平铺时文字的倾斜角度（度）")
+    parser.add_argument("--tile-spacing", type=int, default=defaults.tile_spacing, help="平铺时水印之间的间距（像素）")
+    parser.add_argument("--tile-stagger", type=float, default=defaults.tile_stagger, help="平铺时隔行错开的比例 0-1")
+    parser.add_argument("--logo", help="图片水印（带透明通道的 PNG 等），可与文字一起使用；只要图片水印时加 --text \"\"")
+    parser.add_argument("--logo-scale", type=float, default=defaults.logo_scale, help="图片水印宽度占图片短边的比例")
+    parser.add_argument("--logo-position", choices=POSITIONS, default=defaults.logo_position, help="图片水印位置")
+
+
+def cmd_export(args):
+    paths = collect_inputs(args.inputs, args.recursive)
+    if not paths:
+        print("没有找到可处理的图片", file=sys.stderr)
+        return 1
+    if not check_output_names(duplicate_outputs(paths)):
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    settings = settings_from_args(args)
+    if args.metrics or args.profile_dir or args.tracemalloc:
+        metrics.configure(profile_dir=args.profile_dir, trace_memory=args.tracemalloc)
+
+    # 增量导出：跳过源文件和参数都没变的图片
+    manifest = None
+    todo, skipped = [(path, None) for path in paths], []
+    if not args.no_manifest:
+        manifest = ExportManifest(args.output).load()
+        settings_key = settings_hash(settings)
+        todo, skipped = manifest.plan(paths, settings_key, force=args.force)
+        if skipped and not args.quiet:
+            print(f"跳过 {len(skipped)} 张未变化的图片", file=sys.stderr)
+
+    def progress(result, done, total):
+        if manifest is not None:
+            manifest.record(result, settings_key)
+        if not result["ok"]:
+            if not args.quiet:
+                print(file=sys.stderr)
+            print(f"处理图片 {os.path.basename(result['source'])} 时出错: {result['error']}", file=sys.stderr)
+        if not args.quiet:
+            print(f"\r正在导出: {done}/{total}", end="", file=sys.stderr, flush=True)
+
+    if args.batch:
+        # 同尺寸的图片排在一起处理，合成计划在工作进程中连续命中
+        digests = dict(todo)
+        todo = [(path, digests[path]) for path in group_by_size(list(digests))]
+
+    start = time.perf_counter()
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    try:
+        todo_paths, previous_digests = [path for path, _ in todo], [digest for _, digest in todo]
+        if args.pipeline:
+            threads = args.workers or os.cpu_count() or 1
+            pipeline = ExportPipeline(args.output, settings, io_threads=args.io_threads, render_threads=threads,
+                                      encode_threads=threads, memory_budget=memory_budget,
+                                      track_source=manifest is not None, batch=args.batch)
+            report = pipeline.run(todo_paths, previous_digests, progress=progress)
+        else:
+            report = run_export(todo_paths, args.output, settings, workers=args.workers, chunksize=args.chunksize,
+                                progress=progress, memory_budget=memory_budget, previous_digests=previous_digests,
+                                track_source=manifest is not None, batch=args.batch)
+    except KeyboardInterrupt:
+        print("\n导出已中断，已完成的部分记录在导出清单中，重新运行即可继续", file=sys.stderr)
+        return 130
+    finally:
+        # 中断时也把已完成的部分写进清单，下次从断点继续
+        if manifest is not None:
+            manifest.save()
+        if args.metrics:
+            metrics.write(args.metrics, args.metrics_format)
+    report.extend(skipped_result(path, args.output) for path in skipped)
+    summary = summarize(report, time.perf_counter() - start)
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(f"导出完成，成功{summary['success']}张（其中跳过{summary['skipped']}张），失败{summary['failed']}张，"
+          f"耗时{summary['seconds']}秒（{summary['images_per_second']} 张/秒）")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "files": report}, f, ensure_ascii=False, indent=2)
+    return 0 if summary["failed"] == 0 else 2
+
+
+def cmd_variants(args):
+    paths = collect_inputs(args.inputs, args.recursive)
+    if not paths:
+        print("没有找到可处理的图片", file=sys.stderr)
+        return 1
+    try:
+        variants = load_job(args.job, settings_from_args(args))
+    except (OSError, ValueError, TypeError) as e:
+        print(f"无法读取任务描述 {args.job}: {e}", file=sys.stderr)
+        return 1
+    if not check_output_names(duplicate_variant_outputs(paths, variants)):
+        return 1
+
+    def progress(result, done, total):
+        if not result["ok"]:
+            if not args.quiet:
+                print(file=sys.stderr)
+            print(f"处理图片 {os.path.basename(result['source'])} 时出错: {result['error']}", file=sys.stderr)
+        if not args.quiet:
+            print(f"\r正在导出: {done}/{total}", end="", file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    report = run_variants(paths, args.output, variants, workers=args.workers, chunksize=args.chunksize,
+                          encode_threads=args.encode_threads, progress=progress)
+    summary = summarize(report, time.perf_counter() - start)
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(f"导出完成，{len(variants)} 个版本，成功{summary['success']}张，失败{summary['failed']}张，"
+          f"耗时{summary['seconds']}秒（{summary['images_per_second']} 张/秒）")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "files": report}, f, ensure_ascii=False, indent=2)
+    return 0 if summary["failed"] == 0 else 2
+
+
+def cmd_shard(args):
+    paths = collect_inputs(args.inputs, args.recursive)
+    if not paths:
+        print("没有找到可处理的图片", file=sys.stderr)
+        return 1
+    if not check_output_names(duplicate_outputs(paths)):
+        return 1
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    job = ShardedExport(args.output, settings_from_args(args), shard=shard,
+                        lease_ttl=args.lease_ttl, node_id=args.node_id, state_dir=args.state_dir,
+                        workers=args.workers, memory_budget=memory_budget)
+
+    def progress(result, done):
+        if not result["ok"]:
+            if not args.quiet:
+                print(file=sys.stderr)
+            print(f"处理图片 {os.path.basename(result['source'])} 时出错: {result['error']}", file=sys.stderr)
+        if not args.quiet:
+            print(f"\r节点 {job.node_id} 已处理: {done}", end="", file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    try:
+        report = job.run(paths, roots=args.inputs, progress=progress)
+    except KeyboardInterrupt:
+        print("\n已中断，已完成的图片不会重复处理，未完成的可由其他节点或重新运行接手", file=sys.stderr)
+        return 130
+    summary = summarize(report, time.perf_counter() - start)
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(f"节点 {job.node_id} 完成，成功{summary['success']}张，失败{summary['failed']}张，"
+          f"耗时{summary['seconds']}秒（{summary['images_per_second']} 张/秒）")
+    return 0 if summary["failed"] == 0 else 2
+
+
+def cmd_shard_merge(args):
+    paths = collect_inputs(args.inputs, args.recursive) if args.inputs else None
+    merged = merge_reports(args.output, args.state_dir, paths, roots=args.inputs or ())
+    summary = merged["summary"]
+    for node, node_summary in summary["nodes"].items():
+        print(f"{node}: 成功{node_summary['success']}张，失败{node_summary['failed']}张，耗时{node_summary['seconds']}秒")
+    print(f"合计 {summary['total']} 张，成功{summary['success']}张，失败{summary['failed']}张，"
+          f"重复处理{summary['duplicates']}张")
+    if not args.no_manifest:
+        recorded = record_in_manifest(merged, args.output)
+        print(f"已写入导出清单 {recorded} 条", file=sys.stderr)
+    missing = merged.get("missing", [])
+    if missing:
+        print(f"还有 {len(missing)} 张图片没有处理成功:", file=sys.stderr)
+        for path in missing[:20]:
+            print(f"  {path}", file=sys.stderr)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(merged, f, ensure_ascii=False, indent=2)
+    return 0 if summary["failed"] == 0 and not missing else 2
+
+
+def cmd_watch(args):
+    missing = [folder for folder in args.folders if not os.path.isdir(folder)]
+    if missing:
+        print(f"文件夹不存在: {', '.join(missing)}", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    settings = settings_from_args(args)
+
+    def on_result(result):
+        name = os.path.basename(result["source"])
+        if not result["ok"]:
+            print(f"处理图片 {name} 时出错: {result['error']}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"{time.strftime('%H:%M:%S')} 已导出 {name}（{result['latency']:.2f} 秒）", file=sys.stderr)
+
+    watcher = FolderWatcher(args.folders, args.output, settings, workers=args.workers, recursive=args.recursive,
+                            settle=args.settle, poll_interval=args.poll_interval, batch_window=args.batch_window,
+                            max_batch=args.max_batch, polling=args.polling, use_manifest=not args.no_manifest,
+                            on_result=on_result)
+    if not args.quiet:
+        print(f"正在监视 {', '.join(args.folders)}，按 Ctrl+C 退出", file=sys.stderr)
+    run_until_signalled(watcher)
+    return 0
+
+
+def cmd_serve(args):
+    settings = settings_from_args(args)
+    service = WatermarkService(settings, workers=args.workers, max_concurrency=args.max_concurrency,
+                               max_queue=args.max_queue, allowed_roots=args.allow_root)
+    print(f"水印服务已启动: http://{args.host}:{args.port}/watermark，按 Ctrl+C 退出", file=sys.stderr)
+    serve(service, args.host, args.port, quiet=args.quiet)
+    return 0
+
+
+def cmd_fonts(args):
+    index = default_font_index()
+    if args.rescan:
+        index.rescan()
+    scripts = needed_scripts(args.text)
+    for face in index.faces:
+        if scripts.issubset(face["scripts"]):
+            print(f"{face['family']}\t{face['style']}\t{','.join(face['scripts'])}\t{face['path']}#{face['index']}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="照片水印工具（命令行版）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="批量添加水印并导出")
+    export.add_argument("inputs", nargs="+", help="图片文件或文件夹")
+    export.add_argument("-o", "--output", required=True, help="输出文件夹")
+    add_settings_arguments(export)
+    export.add_argument("-j", "--workers", type=int, default=None, help="工作进程数（默认 CPU 核数）")
+    export.add_argument("--chunksize", type=int, default=None, help="每次分发给工作进程的图片数")
+    export.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help="每个工作进程的内存预算；解码后超出预算的 TIFF/BMP 按条带流式处理（其他格式仍完整解码）")
+    export.add_argument("--pipeline", action="store_true",
+                        help="单进程流水线导出：预读、解码加水印、编码分别由不同线程并行（-j 为每阶段的线程数）")
+    export.add_argument("--io-threads", type=int, default=DEFAULT_IO_THREADS, help="流水线模式下预读文件的线程数")
+    export.add_argument("--batch", action="store_true",
+                        help="按尺寸分组处理，同尺寸的图片复用预先裁剪好的水印合成计划（平铺水印时明显更快）")
+    export.add_argument("-r", "--recursive", action="store_true", help="同时处理子文件夹中的图片")
+    export.add_argument("--metrics", help="保存各阶段耗时、计数器和缓存命中率（.json，或 .prom/.txt 为 Prometheus 格式）")
+    export.add_argument("--metrics-format", choices=("json", "prometheus"), help="--metrics 的格式（默认按扩展名）")
+    export.add_argument("--profile-dir", help="对每张图片运行 cProfile，.prof 文件保存到该目录")
+    export.add_argument("--tracemalloc", action="store_true", help="用 tracemalloc 记录每张图片的内存分配峰值（较慢）")
+    export.add_argument("--force", action="store_true", help="忽略导出清单，全部重新生成")
+    export.add_argument("--no-manifest", action="store_true", help="不读写输出文件夹中的导出清单")
+    export.add_argument("--report", help="逐文件结果报告（JSON）的保存路径")
+    export.add_argument("-q", "--quiet", action="store_true", help="不显示进度")
+    export.set_defaults(func=cmd_export)
+
+    variants = subparsers.add_parser("variants", help="每张图片解码一次，按任务描述导出多个尺寸/格式的版本")
+    variants.add_argument("inputs", nargs="+", help="图片文件或文件夹")
+    variants.add_argument("-o", "--output", required=True, help="输出文件夹（每个版本一个子文件夹）")
+    variants.add_argument("--job", required=True, help="任务描述（JSON），列出各版本的尺寸、格式、质量和水印参数")
+    add_settings_arguments(variants)
+    variants.add_argument("-j", "--workers", type=int, default=None, help="工作进程数（默认 CPU 核数）")
+    variants.add_argument("--chunksize", type=int, default=None, help="每次分发给工作进程的图片数")
+    variants.add_argument("--encode-threads", type=int, default=None, help="每张图片并行编码的线程数（默认等于版本数）")
+    variants.add_argument("-r", "--recursive", action="store_true", help="同时处理子文件夹中的图片")
+    variants.add_argument("--report", help="逐文件结果报告（JSON）的保存路径")
+    variants.add_argument("-q", "--quiet", action="store_true", help="不显示进度")
+    variants.set_defaults(func=cmd_variants)
+
+    shard = subparsers.add_parser("shard", help="多台机器共享存储分片导出（每台机器各运行一次）")
+    shard.add_argument("inputs", nargs="+", help="图片文件或文件夹（各节点相同）")
+    shard.add_argument("-o", "--output", required=True, help="共享的输出文件夹")
+    add_settings_arguments(shard)
+    mode = shard.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--shard", metavar="K/N", help="哈希分片：本节点处理第 K 份（共 N 份，K 从 0 开始）")
+    mode.add_argument("--lease", action="store_true", help="租约：各节点按需领取图片，崩溃节点的图片过期后由其他节点接手")
+    shard.add_argument("--lease-ttl", type=float, default=DEFAULT_LEASE_TTL,
+                       help="租约多少秒没有续约视为节点已崩溃（应远大于节点之间的时钟误差）")
+    shard.add_argument("--node-id", default=None, help="节点名（默认 主机名-进程号）")
+    shard.add_argument("--state-dir", default=None, help="租约、完成标记和报告的目录（默认输出文件夹下的 .watermark_shards）")
+    shard.add_argument("-j", "--workers", type=int, default=None, help="本节点的工作进程数（默认 CPU 核数）")
+    shard.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                       help="每个工作进程的内存预算；解码后超出预算的 TIFF/BMP 按条带流式处理（其他格式仍完整解码）")
+    shard.add_argument("-r", "--recursive", action="store_true", help="同时处理子文件夹中的图片")
+    shard.add_argument("-q", "--quiet", action="store_true", help="不显示进度")
+    shard.set_defaults(func=cmd_shard)
+
+    shard_merge = subparsers.add_parser("shard-merge", help="汇总各节点的分片导出报告")
+    shard_merge.add_argument("output", help="共享的输出文件夹")
+    shard_merge.add_argument("--state-dir", default=None, help="与 shard 命令的 --state-dir 相同")
+    shard_merge.add_argument("--inputs", nargs="+", help="本机上的全部输入（与 shard 命令相同，挂载路径可以不同；指定时列出还没有处理成功的图片，导出清单按本机路径记录）")
+    shard_merge.add_argument("-r", "--recursive", action="store_true", help="--inputs 包含子文件夹")
+    shard_merge.add_argument("--no-manifest", action="store_true", help="不写入输出文件夹的导出清单")
+    shard_merge.add_argument("--report", help="汇总报告（JSON）的保存路径")
+    shard_merge.set_defaults(func=cmd_shard_merge)
+
+    watch = subparsers.add_parser("watch", help="监视文件夹，为新放入的图片持续添加水印")
+    watch.add_argument("folders", nargs="+", help="要监视的文件夹")
+    watch.add_argument("-o", "--output", required=True, help="输出文件夹")
+    add_settings_arguments(watch)
+    watch.add_argument("-j", "--workers", type=int, default=None, help="工作进程数（默认 CPU 核数）")
+    watch.add_argument("-r", "--recursive", action="store_true", help="同时监视子文件夹（包括之后新建的）")
+    watch.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                       help="文件大小和修改时间持续多少秒不变才认为已写完")
+    watch.add_argument("--polling", action="store_true", help="不用 inotify，定时扫描（网络共享盘上使用）")
+    watch.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="定时扫描的间隔（秒）")
+    watch.add_argument("--batch-window", type=float, default=DEFAULT_BATCH_WINDOW,
+                       help="写完的文件攒多久（秒）再一起提交给工作进程")
+    watch.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH, help="一个批次最多的图片数")
+    watch.add_argument("--no-manifest", action="store_true", help="不读写导出清单（重启后会重新处理已有文件）")
+    watch.add_argument("-q", "--quiet", action="store_true", help="只输出错误")
+    watch.set_defaults(func=cmd_watch)
+
+    server = subparsers.add_parser("serve", help="启动本地 HTTP 水印服务")
+    server.add_argument("--host", default=DEFAULT_HOST, help="监听地址（默认只接受本机连接）")
+    server.add_argument("--port", type=int, default=DEFAULT_PORT, help="监听端口")
+    add_settings_arguments(server)
+    server.add_argument("-j", "--workers", type=int, default=None, help="工作进程数（默认 CPU 核数）")
+    server.add_argument("--max-concurrency", type=int, default=None,
+                        help="同时交给工作进程的请求数（默认工作进程数的 2 倍），其余排队")
+    server.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE, help="排队的请求数上限，超出时返回 503")
+    server.add_argument("--allow-root", action="append", default=[], metavar="DIR",
+                        help="允许按路径处理的文件夹（可重复；不指定时只能上传图片）")
+    server.add_argument("-q", "--quiet", action="store_true", help="不输出访问日志")
+    server.set_defaults(func=cmd_serve)
+
+    fonts = subparsers.add_parser("fonts", help="列出系统字体索引")
+    fonts.add_argument("--text", help="只列出能显示这段文字的字体")
+    fonts.add_argument("--rescan", action="store_true", help="忽略缓存重新扫描字体目录")
+    fonts.set_defaults(func=cmd_fonts)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,509 @@
+"""水印渲染引擎：不依赖 Tk，图形界面和命令行共用同一套渲染逻辑"""
+import math
+import os
+import re
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+from watermark_fonts import default_font_index
+from watermark_metrics import lru_cache_source, metrics
+
+# 支持的图片扩展名（与图形界面的文件选择保持一致）
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# 水印布局：单个水印 / 倾斜平铺
+LAYOUTS = ("single", "tiled")
+
+# 九宫格位置
+POSITIONS = ("top-left", "top-center", "top-right",
+             "middle-left", "center", "middle-right",
+             "bottom-left", "bottom-center", "bottom-right")
+
+# 候选字体（按优先级排列）
+FONT_CANDIDATES = [
+    "/System/Library/Fonts/PingFang.ttc",  # 苹方，支持中文
+    "/System/Library/Fonts/Helvetica.ttc",  # 系统默认
+    "/System/Library/Fonts/Arial.ttf",  # Arial
+]
+
+
+@dataclass(frozen=True)
+class WatermarkSettings:
+    """水印参数（纯数据，可跨进程传递）"""
+    text: str = "测试水印"
+    color: str = "#FF0000"
+    font_size: int = 48
+    opacity: int = 70  # 0-100
+    position: str = "bottom-right"
+    font_path: str = None  # None 表示使用默认字体
+    font_index: int = 0  # .ttc 字体集中的序号
+    layout: str = "single"  # single：单个水印（按 position 放置）；tiled：倾斜平铺满整张图片
+    tile_angle: float = 30.0  # 平铺时文字的倾斜角度（逆时针，度）
+    tile_spacing: int = 80  # 平铺时相邻水印之间的间距（像素）
+    tile_stagger: float = 0.5  # 平铺时隔行水平错开的比例（0-1）
+    logo_path: str = None  # 图片水印（带透明通道的 PNG 等），None 表示不加
+    logo_scale: float = 0.15  # 图片水印宽度占图片短边的比例
+    logo_position: str = "bottom-left"
+
+    def with_changes(self, **changes):
+        return replace(self, **changes)
+
+
+# 外部给出的参数（HTTP 请求、多版本任务描述）按字段的类型注解转换（默认值的类型不一定对，如默认值是 None 的字段）
+SETTING_TYPES = {field.name: field.type for field in fields(WatermarkSettings)}
+# 取值范围 (最小值, 最大值)，None 表示不限；字号、间距和图片水印比例过大时单个水印就要占几个 GB 内存
+SETTING_RANGES = {"font_size": (1, 2000), "opacity": (0, 100), "font_index": (0, None), "tile_spacing": (0, 2000),
+                  "tile_stagger": (0, 1), "logo_scale": (0.01, 1)}
+SETTING_CHOICES = {"position": POSITIONS, "layout": LAYOUTS, "logo_position": POSITIONS}
+COLOR_PATTERN = re.compile(r"#[0-9A-Fa-f]{6}")
+
+
+def check_setting(name, value):
+    """把外部给出的参数值转换成字段的类型并检查取值，返回转换后的值；不合法时抛出 ValueError"""
+    if value is None and getattr(WatermarkSettings, name) is None:
+        return None
+    try:
+        value = SETTING_TYPES[name](value)
+    except (TypeError, ValueError):
+        raise ValueError(f"参数 {name} 的值无效: {value!r}") from None
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"参数 {name} 的值无效: {value!r}")
+    low, high = SETTING_RANGES.get(name, (None, None))
+    if (low is not None and value < low) or (high is not None and value > high):
+        limits = f"应为 {low}-{high}" if high is not None else f"应不小于 {low}"
+        raise ValueError(f"参数 {name} {limits}: {value!r}")
+    if name in SETTING_CHOICES and value not in SETTING_CHOICES[name]:
+        raise ValueError(f"参数 {name} 应为 {', '.join(SETTING_CHOICES[name])} 之一")
+    if name == "color" and not COLOR_PATTERN.fullmatch(value):
+        raise ValueError(f"参数 color 应为 #RRGGBB 格式: {value!r}")
+    return value
+
+
+def find_available_font(text=None, family=None):
+    """查找可用字体，返回 (路径, 索引)，都不可用时返回 None
+
+    指定 family 时按字体族名查找；否则先试候选字体，再从系统字体索引里挑一个能显示 text 的字体。
+    """
+    if family:
+        return default_font_index().find(family=family, text=text)
+    for font_path in FONT_CANDIDATES:
+        if os.path.exists(font_path):
+            return font_path, 0
+    index = default_font_index()
+    return index.find(text=text) or index.find()
+
+
+@lru_cache(maxsize=128)
+def load_font(font_path, index, size):
+    """加载字体（按路径、索引、大小缓存 FreeTypeFont 对象）"""
+    with metrics.stage("font_load"):
+        return ImageFont.truetype(font_path, size, index=index)
+
+
+def get_font(font_path, size, index=0):
+    """获取指定大小的字体"""
+    if font_path:
+        try:
+            return load_font(font_path, index, size)
+        except Exception:
+            return ImageFont.load_default()
+    return ImageFont.load_default()
+
+
+def parse_color(color):
+    """十六进制颜色转 (r, g, b)"""
+    return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
+
+
+def calculate_position(image_size, box_size, position):
+    """计算水印框（宽, 高）在图片中的左上角坐标"""
+    width, height = image_size
+    text_width, text_height = box_size
+
+    # 动态边距（避免水印贴边）
+    margin = min(width, height) * 0.02
+    if margin < 10:
+        margin = 10
+
+    # 位置映射（基于原始图片尺寸计算，确保位置准确）
+    position_map = {
+        "top-left": (margin, margin),
+        "top-center": ((width - text_width) // 2, margin),
+        "top-right": (width - text_width - margin, margin),
+        "middle-left": (margin, (height - text_height) // 2),
+        "center": ((width - text_width) // 2, (height - text_height) // 2),
+        "middle-right": (width - text_width - margin, (height - text_height) // 2),
+        "bottom-left": (margin, height - text_height - margin),
+        "bottom-center": ((width - text_width) // 2, height - text_height - margin),
+        "bottom-right": (width - text_width - margin, height - text_height - margin)
+    }
+
+    x, y = position_map[position]
+    return int(round(x)), int(round(y))
+
+
+def measure_text(text, font):
+    """文字墨迹范围 (left, top, right, bottom)，相对 draw.text 的起点"""
+    # 用 1x1 的临时画布测量，不需要真正栅格化
+    return ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+
+
+def stamp_box(image_size, settings, font_size=None):
+    """水印图章在图片中的位置 (left, top, width, height)，与 add_watermark_to_image 一致但不栅格化"""
+    font = get_font(settings.font_path, font_size or settings.font_size, settings.font_index)
+    bbox = measure_text(settings.text, font)
+    size = (max(1, bbox[2] - bbox[0]), max(1, bbox[3] - bbox[1]))
+    x, y = calculate_position(image_size, size, settings.position)
+    return x + bbox[0], y + bbox[1], size[0], size[1]
+
+
+@lru_cache(maxsize=64)
+def render_stamp(text, font_path, font_index, font_size, color, opacity):
+    """栅格化水印文字（按参数缓存）
+
+    返回 (图章, 偏移)：图章是刚好包住文字的 RGBA 图，偏移是它相对 draw.text 起点的位置
+    """
+    font = get_font(font_path, font_size, font_index)
+    with metrics.stage("stamp"):
+        bbox = measure_text(text, font)
+        size = (max(1, bbox[2] - bbox[0]), max(1, bbox[3] - bbox[1]))
+
+        stamp = Image.new('RGBA', size, (0, 0, 0, 0))
+        r, g, b = parse_color(color)
+        ImageDraw.Draw(stamp).text((-bbox[0], -bbox[1]), text, font=font,
+                                   fill=(r, g, b, int(255 * (opacity / 100))))
+    return stamp, (bbox[0], bbox[1])
+
+
+def stamp_for(settings, font_size=None):
+    return render_stamp(settings.text, settings.font_path, settings.font_index, font_size or settings.font_size,
+                        settings.color, settings.opacity)
+
+
+@lru_cache(maxsize=16)
+def render_tile(text, font_path, font_index, font_size, color, opacity, angle, spacing, stagger):
+    """平铺水印的重复单元（按参数缓存）
+
+    文字只栅格化、旋转一次；单元宽为一个旋转后的水印加间距，高为两行，第二行水平错开 stagger。
+    返回 (单元图, 旋转后水印的尺寸)。
+    """
+    stamp, _ = render_stamp(text, font_path, font_index, font_size, color, opacity)
+    with metrics.stage("tile"):
+        # 颜色铺满整张图、只有 alpha 来自文字，旋转插值时边缘不会混入黑色
+        solid = Image.new('RGBA', stamp.size, (*parse_color(color), 255))
+        solid.putalpha(stamp.getchannel('A'))
+        rotated = solid.rotate(angle, Image.Resampling.BICUBIC, expand=True, fillcolor=(*parse_color(color), 0))
+        spacing = max(0, spacing)
+        cell_width, cell_height = rotated.width + spacing, rotated.height + spacing
+        tile = Image.new('RGBA', (cell_width, cell_height * 2), (0, 0, 0, 0))
+        tile.paste(rotated, (0, 0))
+        shift = int(round(stagger * cell_width)) % cell_width
+        # 错开的一行超出单元右边的部分从左边绕回来
+        tile.paste(rotated, (shift, cell_height))
+        if shift + rotated.width > cell_width:
+            tile.paste(rotated, (shift - cell_width, cell_height))
+    return tile, rotated.size
+
+
+def tile_for(settings, font_size=None):
+    """按字体大小缩放（预览）时间距同比缩放"""
+    scale = (font_size or settings.font_size) / settings.font_size
+    return render_tile(settings.text, settings.font_path, settings.font_index, font_size or settings.font_size,
+                       settings.color, settings.opacity, settings.tile_angle,
+                       int(round(settings.tile_spacing * scale)), settings.tile_stagger)
+
+
+def tile_anchor(image_size, stamp_size):
+    """平铺图案的基准点：让一个水印正好位于图片中心"""
+    return (image_size[0] - stamp_size[0]) // 2, (image_size[1] - stamp_size[1]) // 2
+
+
+def blend_tiled(image, tile, anchor, bounds=None):
+    """把重复单元铺满 bounds（默认整张图片），anchor 是任意一个单元的左上角（原地修改 image）
+
+    每个单元都是一次 C 层的贴图，总开销约等于整张图片合成一遍，不需要整图大小的水印层。
+    """
+    for part, xy in tile_placements(tile, anchor, bounds or (0, 0, image.width, image.height)):
+        blend_stamp(image, part, xy)
+    return image
+
+
+def tile_placements(tile, anchor, bounds):
+    """铺满 bounds (left, top, right, bottom) 所需的 (单元, (x, y))，边缘的单元裁到 bounds 以内"""
+    left, top, right, bottom = bounds
+    tile_width, tile_height = tile.size
+    start_x = left - (left - anchor[0]) % tile_width
+    start_y = top - (top - anchor[1]) % tile_height
+    for y in range(start_y, bottom, tile_height):
+        for x in range(start_x, right, tile_width):
+            if x >= left and y >= top and x + tile_width <= right and y + tile_height <= bottom:
+                yield tile, (x, y)
+            else:
+                box = (max(x, left) - x, max(y, top) - y, min(x + tile_width, right) - x,
+                       min(y + tile_height, bottom) - y)
+                yield tile.crop(box), (x + box[0], y + box[1])
+
+
+# 图片水印的缩放阶梯最多缩小到这个宽度
+LOGO_LADDER_MIN_WIDTH = 32
+
+
+@lru_cache(maxsize=8)
+def load_logo(logo_path, mtime_ns):
+    """读入图片水印原图（mtime 参与缓存键，文件更新后重新读取）"""
+    with Image.open(logo_path) as logo:
+        return logo.convert('RGBA')
+
+
+@lru_cache(maxsize=32)
+def logo_level(logo_path, mtime_ns, factor):
+    """缩放阶梯：原图缩小 factor（2 的幂）倍，每一级由上一级缩小一半得到"""
+    if factor == 1:
+        return load_logo(logo_path, mtime_ns)
+    larger = logo_level(logo_path, mtime_ns, factor // 2)
+    size = (max(1, larger.width // 2), max(1, larger.height // 2))
+    return larger.resize(size, Image.Resampling.LANCZOS)
+
+
+@lru_cache(maxsize=64)
+def render_logo(logo_path, mtime_ns, width, opacity):
+    """按精确宽度缩放并应用透明度的图片水印（按参数缓存）
+
+    从阶梯中不小于目标宽度的最小一级重采样，而不是每次都从原图开始。
+    """
+    source = load_logo(logo_path, mtime_ns)
+    factor = 1
+    while source.width // (factor * 2) >= max(width, LOGO_LADDER_MIN_WIDTH):
+        factor *= 2
+    level = logo_level(logo_path, mtime_ns, factor)
+    height = max(1, round(source.height * width / source.width))
+    with metrics.stage("logo"):
+        logo = level if level.size == (width, height) else level.resize((width, height), Image.Resampling.LANCZOS)
+        if opacity < 100:
+            logo = logo.copy()
+            logo.putalpha(logo.getchannel('A').point([a * opacity // 100 for a in range(256)]))
+    return logo
+
+
+def logo_for(image_size, settings, scale=1.0):
+    """图片水印及其在图片中的位置 (x, y)
+
+    宽度按原图短边的比例计算；scale 用于预览（位置在原图上计算后再缩放，与导出结果一致）。
+    """
+    mtime_ns = os.stat(settings.logo_path).st_mtime_ns
+    source = load_logo(settings.logo_path, mtime_ns)
+    width = max(1, round(min(image_size) * settings.logo_scale))
+    height = max(1, round(source.height * width / source.width))
+    x, y = calculate_position(image_size, (width, height), settings.logo_position)
+    if scale != 1.0:
+        width, x, y = max(1, round(width * scale)), int(round(x * scale)), int(round(y * scale))
+    return render_logo(settings.logo_path, mtime_ns, width, settings.opacity), (x, y)
+
+
+def has_watermark(settings):
+    """是否有需要叠加的内容（文字或图片水印，且不是完全透明）"""
+    return bool(settings.text or settings.logo_path) and settings.opacity > 0
+
+
+metrics.register_cache("font", lru_cache_source(load_font))
+metrics.register_cache("stamp", lru_cache_source(render_stamp))
+metrics.register_cache("tile", lru_cache_source(render_tile))
+metrics.register_cache("logo", lru_cache_source(render_logo))
+
+
+def normalize_mode(image):
+    """带透明通道的图片转 RGBA，其余转 RGB（JPEG 全程保持 RGB）"""
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+    if image.mode in ('LA', 'PA') or 'transparency' in image.info:
+        return image.convert('RGBA')
+    return image.convert('RGB')
+
+
+def blend_stamp(image, stamp, xy):
+    """只在图章覆盖的区域内混合（原地修改 image）"""
+    x, y = xy
+    if image.mode == 'RGBA':
+        # 透明底图用 alpha_composite 语义；该接口不接受负坐标，先裁掉超出部分
+        left, top = max(0, x), max(0, y)
+        right = min(image.width, x + stamp.width)
+        bottom = min(image.height, y + stamp.height)
+        if right <= left or bottom <= top:
+            return image
+        image.alpha_composite(stamp, dest=(left, top), source=(left - x, top - y, right - x, bottom - y))
+    else:
+        image.paste(stamp, (x, y), stamp)
+    return image
+
+
+def add_watermark_to_image(image, settings, font_size=None, inplace=False):
+    """返回添加水印后的图片（RGB 或 RGBA）；font_size 用于预览时覆盖设置中的字体大小"""
+    converted = normalize_mode(image)
+    if converted is image and not inplace:
+        converted = image.copy()
+    image = converted
+
+    if not has_watermark(settings):
+        return image
+
+    if settings.logo_path:
+        logo, xy = logo_for(image.size, settings)
+        with metrics.stage("composite"):
+            blend_stamp(image, logo, xy)
+    if not settings.text:
+        return image
+
+    if settings.layout == "tiled":
+        tile, stamp_size = tile_for(settings, font_size)
+        with metrics.stage("composite"):
+            return blend_tiled(image, tile, tile_anchor(image.size, stamp_size))
+
+    stamp, (dx, dy) = stamp_for(settings, font_size)
+    with metrics.stage("position"):
+        x, y = calculate_position(image.size, stamp.size, settings.position)
+    with metrics.stage("composite"):
+        return blend_stamp(image, stamp, (x + dx, y + dy))
+
+
+def stamp_placements(image_size, settings):
+    """要贴到图片上的 [(图章, (x, y))]，顺序和位置与 add_watermark_to_image 一致"""
+    placements = []
+    if not has_watermark(settings):
+        return placements
+    if settings.logo_path:
+        placements.append(logo_for(image_size, settings))
+    if settings.text and settings.layout == "tiled":
+        tile, stamp_size = tile_for(settings)
+        placements.extend(tile_placements(tile, tile_anchor(image_size, stamp_size), (0, 0, *image_size)))
+    elif settings.text:
+        stamp, (dx, dy) = stamp_for(settings)
+        x, y = calculate_position(image_size, stamp.size, settings.position)
+        placements.append((stamp, (x + dx, y + dy)))
+    return placements
+
+
+def overlay_for(image_size, settings):
+    """按区域处理图片（流式处理的条带/瓦片）时使用的水印
+
+    返回 (覆盖范围 (left, top, width, height), blend)；blend(region, (region_left, region_top))
+    把水印中落在该区域内的部分混合到 region 上（RGB/RGBA，原地修改并返回 region）。
+    """
+    parts = []
+    if settings.logo_path:
+        logo, (logo_x, logo_y) = logo_for(image_size, settings)
+
+        def blend_logo(region, offset):
+            return blend_stamp(region, logo, (logo_x - offset[0], logo_y - offset[1]))
+
+        parts.append(((logo_x, logo_y, logo.width, logo.height), blend_logo))
+
+    if settings.text and settings.layout == "tiled":
+        tile, stamp_size = tile_for(settings)
+        anchor = tile_anchor(image_size, stamp_size)
+
+        def blend_text(region, offset):
+            return blend_tiled(region, tile, (anchor[0] - offset[0], anchor[1] - offset[1]))
+
+        parts.append(((0, 0, image_size[0], image_size[1]), blend_text))
+    elif settings.text:
+        stamp, _ = stamp_for(settings)
+        box = stamp_box(image_size, settings)
+
+        def blend_text(region, offset):
+            return blend_stamp(region, stamp, (box[0] - offset[0], box[1] - offset[1]))
+
+        parts.append((box, blend_text))
+
+    if not parts:
+        return (0, 0, 0, 0), lambda region, offset: region
+    # 文字和图片水印都有时覆盖范围取两者的外接矩形
+    left = min(box[0] for box, _ in parts)
+    top = min(box[1] for box, _ in parts)
+    right = max(box[0] + box[2] for box, _ in parts)
+    bottom = max(box[1] + box[3] for box, _ in parts)
+
+    def blend(region, offset):
+        for _, blend_part in parts:
+            region = blend_part(region, offset)
+        return region
+
+    return (left, top, right - left, bottom - top), blend
+
+
+def output_path_for(image_path, output_dir):
+    """导出文件路径：watermarked_<原文件名>"""
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    return os.path.join(output_dir, f"watermarked_{name}{ext}")
+
+
+def duplicate_outputs(paths):
+    """导出文件名相同、会互相覆盖的源文件 {输出文件名: [源文件, ...]}
+
+    输出只按文件名命名，不同文件夹中的同名图片（如包含子文件夹时）会写到同一个输出文件，导出前需要拒绝。
+    """
+    sources = {}
+    for path in paths:
+        sources.setdefault(os.path.basename(output_path_for(path, "")), []).append(path)
+    return {name: group for name, group in sources.items() if len(group) > 1}
+
+
+def save_image(image, output_path, ext=None):
+    """按格式保存；output_path 也可以是文件对象，此时由 ext 指定格式（如 ".png"）"""
+    ext = ext or os.path.splitext(output_path)[1]
+    if ext.lower() in ['.png']:
+        image.save(output_path, "PNG", compress_level=6)
+    else:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(output_path, "JPEG", quality=95)
+
+
+def render_file(image_path, settings, source=None, watermark=None):
+    """解码图片并添加水印，返回图片（不保存）
+
+    source 是已读入内存的文件对象（如 BytesIO），默认直接打开 image_path；
+    watermark 是与 add_watermark_to_image 签名相同的合成函数（默认即 add_watermark_to_image）。
+    """
+    with Image.open(source or image_path) as original:
+        with metrics.stage("decode"):
+            original.load()
+        return (watermark or add_watermark_to_image)(original, settings, inplace=True)
+
+
+def save_output(image, image_path, output_dir):
+    """把处理后的图片保存到导出路径，返回输出路径"""
+    output_path = output_path_for(image_path, output_dir)
+    with metrics.stage("encode"):
+        save_image(image, output_path)
+    if metrics.enabled:
+        metrics.count("bytes_written", os.path.getsize(output_path))
+    return output_path
+
+
+def watermark_file(image_path, output_dir, settings, source=None, watermark=None):
+    """为单个文件添加水印并保存，返回输出路径；出错时抛出异常"""
+    return save_output(render_file(image_path, settings, source, watermark), image_path, output_dir)
+
+
+def iter_images(folder, recursive=False):
+    """单次遍历文件夹（os.scandir），按文件名顺序产出图片路径；recursive 为真时先文件后子文件夹"""
+    with os.scandir(folder) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    subdirs = []
+    for entry in entries:
+        try:
+            if entry.is_file():
+                if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+        except OSError:
+            continue
+    for subdir in subdirs:
+        try:
+            yield from iter_images(subdir, recursive=True)
+        except OSError:
+            continue
+
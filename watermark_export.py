@@ -0,0 +1,336 @@
+"""批量导出：单张图片的导出任务和多进程调度（命令行与图形界面共用）"""
+import io
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+
+from PIL import UnidentifiedImageError
+
+from watermark_batch import add_watermark_batched
+from watermark_engine import output_path_for, watermark_file
+from watermark_manifest import ExportManifest, bytes_digest, file_digest, settings_hash
+from watermark_metrics import configure_worker, metrics
+from watermark_stream import should_stream, watermark_file_streaming
+
+
+# 预读时整个文件读入内存的大小上限，更大的文件在渲染阶段直接按路径打开
+PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+
+
+def new_result(image_path):
+    return {"source": image_path, "output": None, "ok": False, "skipped": False, "error": None}
+
+
+def read_source(image_path, result, memory_budget=None, track_source=False, prefetch=False, streaming=False):
+    """读取源文件，返回内存中的文件对象；不需要预读（或文件太大）时返回 None，由解码时按路径打开
+
+    track_source 为真时在 result 中记录源文件的大小、mtime 和内容哈希。
+    streaming 为真时（图片将按条带流式处理）不读入内存，只分块计算哈希。
+    """
+    if not (track_source or prefetch):
+        return None
+    stat = os.stat(image_path)
+    if track_source:
+        result.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    too_large = (streaming or (memory_budget and stat.st_size > memory_budget // 4)
+                 or (prefetch and stat.st_size > PREFETCH_MAX_BYTES))
+    with metrics.stage("read"):
+        if too_large:
+            if track_source:
+                result["digest"] = file_digest(image_path)
+            return None
+        # 只读一次文件：同一份字节既用来算哈希也用来解码
+        with open(image_path, "rb") as f:
+            data = f.read()
+        if track_source:
+            result["digest"] = bytes_digest(data)
+    return io.BytesIO(data)
+
+
+def mark_unchanged(result, output_dir, previous_digest):
+    """内容哈希与上次相同（只是 mtime 变了）时标记为跳过，返回是否跳过"""
+    if previous_digest and result.get("digest") == previous_digest:
+        result.update(output=output_path_for(result["source"], output_dir), ok=True, skipped=True)
+        return True
+    return False
+
+
+def error_message(image_path, error):
+    if isinstance(error, UnidentifiedImageError):
+        # 从内存解码时 Pillow 的报错里只有 BytesIO 对象，这里换成文件路径
+        return f"cannot identify image file {image_path!r}"
+    return str(error)
+
+
+def export_one(image_path, output_dir, settings, memory_budget=None, previous_digest=None, track_source=False,
+               batch=False):
+    """处理单张图片，返回结果记录（不抛出异常）
+
+    指定 memory_budget（字节）时，按文件头判断解码后超出预算的图片按条带流式处理（与文件本身大小无关）。
+    track_source 为真时在结果中附带源文件的大小、mtime 和内容哈希（供增量导出清单使用）；
+    内容哈希与 previous_digest 相同时说明只是 mtime 变了，直接跳过渲染。
+    batch 为真时同尺寸的图片复用同一份合成计划（见 watermark_batch）。
+    """
+    watermark = add_watermark_batched if batch else None
+    start = time.perf_counter()
+    result = new_result(image_path)
+    try:
+        with metrics.image(image_path):
+            streaming = bool(memory_budget) and should_stream(image_path, memory_budget)
+            source = read_source(image_path, result, memory_budget, track_source, streaming=streaming)
+            if mark_unchanged(result, output_dir, previous_digest):
+                return result
+            if streaming:
+                with metrics.stage("stream"):
+                    output_path = watermark_file_streaming(image_path, output_dir, settings, memory_budget)
+            else:
+                output_path = watermark_file(image_path, output_dir, settings, source=source, watermark=watermark)
+            result.update(output=output_path, ok=True)
+    except Exception as e:
+        result["error"] = error_message(image_path, e)
+    finally:
+        result["seconds"] = round(time.perf_counter() - start, 4)
+        if metrics.enabled:
+            count_result(image_path, result)
+    return result
+
+
+def count_result(image_path, result):
+    """把一张图片的结果计入运行指标"""
+    metrics.count("images")
+    if not result["ok"]:
+        metrics.count("images_failed")
+    elif result["skipped"]:
+        metrics.count("images_skipped")
+    try:
+        metrics.count("bytes_read", result.get("size") or os.path.getsize(image_path))
+    except OSError:
+        pass
+
+
+def _export_task(image_path, previous_digest, **options):
+    return export_one(image_path, previous_digest=previous_digest, **options)
+
+
+def _run_task(task, *args):
+    result = task(*args)
+    if metrics.enabled and multiprocessing.parent_process() is not None:
+        # 工作进程的指标随结果带回主进程合并
+        result["metrics"] = metrics.drain()
+    return result
+
+
+def ignore_interrupts():
+    """进程池的 initializer：工作进程忽略 Ctrl+C（SIGINT 会发给整个前台进程组），何时结束由主进程决定"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def default_chunksize(total, workers):
+    """每个工作进程约分到 4 批，单批不超过 64 张"""
+    return max(1, min(64, total // (workers * 4)))
+
+
+def map_export(task, paths, *iterables, workers=None, chunksize=None, progress=None):
+    """并行执行 task(路径, *其余参数)（task 返回结果记录，必须可 pickle），按输入顺序返回结果记录"""
+    workers = workers or os.cpu_count() or 1
+    task = partial(_run_task, task)
+    if workers == 1:
+        results = map(task, paths, *iterables)
+    else:
+        chunksize = chunksize or default_chunksize(len(paths), workers)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=configure_worker,
+                                       initargs=(metrics.config(),))
+        results = executor.map(task, paths, *iterables, chunksize=chunksize)
+
+    report = []
+    try:
+        for result in results:
+            if "metrics" in result:
+                metrics.merge(result.pop("metrics"))
+            report.append(result)
+            if progress:
+                progress(result, len(report), len(paths))
+    finally:
+        if workers != 1:
+            executor.shutdown(cancel_futures=True)
+    return report
+
+
+def run_export(paths, output_dir, settings, workers=None, chunksize=None, progress=None, memory_budget=None,
+               previous_digests=None, track_source=False, batch=False):
+    """并行导出，按输入顺序返回每个文件的结果记录"""
+    task = partial(_export_task, output_dir=output_dir, settings=settings, memory_budget=memory_budget,
+                   track_source=track_source, batch=batch)
+    return map_export(task, paths, previous_digests or [None] * len(paths), workers=workers, chunksize=chunksize,
+                      progress=progress)
+
+
+def skipped_result(image_path, output_dir):
+    """清单判定为最新、无需处理的文件"""
+    return {"source": image_path, "output": output_path_for(image_path, output_dir), "ok": True,
+            "skipped": True, "error": None, "seconds": 0.0}
+
+
+def summarize(report, elapsed):
+    success = sum(1 for r in report if r["ok"])
+    skipped = sum(1 for r in report if r.get("skipped"))
+    return {
+        "total": len(report),
+        "success": success,
+        "skipped": skipped,
+        "failed": len(report) - success,
+        "seconds": round(elapsed, 3),
+        "images_per_second": round(len(report) / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+class ExportStats:
+    """导出吞吐统计：张/秒、MB/秒、预计剩余时间"""
+
+    def __init__(self, total, skipped=0):
+        self.total = total
+        self.skipped = skipped
+        self.done = skipped
+        self.success = skipped
+        self.failed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.start = time.perf_counter()
+        self._processed = 0
+
+    def add(self, result):
+        self.done += 1
+        self._processed += 1
+        if result["ok"]:
+            self.success += 1
+            if result.get("skipped"):
+                self.skipped += 1
+            elif result.get("output"):
+                try:
+                    self.bytes_written += os.path.getsize(result["output"])
+                except OSError:
+                    pass
+        else:
+            self.failed += 1
+        self.bytes_read += result.get("size", 0)
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self._processed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.done
+        return {
+            "total": self.total,
+            "done": self.done,
+            "success": self.success,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "seconds": round(elapsed, 3),
+            "images_per_second": round(rate, 2),
+            "mb_per_second": round(self.bytes_read / elapsed / (1024 * 1024), 2) if elapsed > 0 else 0.0,
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+        }
+
+
+class BackgroundExport:
+    """后台导出任务
+
+    在单独的线程中调度导出（图片本身由线程池处理，Pillow 解码/编码时会释放 GIL），
+    进度通过线程安全的 events 队列报告，由界面线程用 after 轮询。暂停和取消在两张图片之间生效：
+    已经开始的图片会处理完，不会留下写了一半的文件。
+
+    events 中的消息：("progress", 统计快照) / ("done", 统计快照) / ("cancelled", 统计快照) / ("error", 异常信息)
+    """
+
+    def __init__(self, paths, output_dir, settings, workers=None, memory_budget=None, use_manifest=True,
+                 batch=False):
+        self.paths = list(paths)
+        self.batch = batch
+        self.output_dir = output_dir
+        self.settings = settings
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.memory_budget = memory_budget
+        self.use_manifest = use_manifest
+        self.events = queue.Queue()
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="export", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        manifest = None
+        try:
+            # 输出文件夹不可写等错误也要通过 events 报告，界面才不会一直等待
+            os.makedirs(self.output_dir, exist_ok=True)
+            manifest = ExportManifest(self.output_dir).load() if self.use_manifest else None
+            settings_key = settings_hash(self.settings)
+            if manifest is not None:
+                todo, skipped = manifest.plan(self.paths, settings_key)
+            else:
+                todo, skipped = [(path, None) for path in self.paths], []
+            stats = ExportStats(len(self.paths), len(skipped))
+            self.events.put(("progress", stats.snapshot()))
+
+            # 同时在处理中的图片数有上限，暂停/取消时最多等这些图片处理完
+            window = self.workers * 2
+            pending = set()
+            items = iter(todo)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while True:
+                    while len(pending) < window and self._running.is_set() and not self._cancelled.is_set():
+                        item = next(items, None)
+                        if item is None:
+                            break
+                        image_path, previous_digest = item
+                        pending.add(executor.submit(
+                            export_one, image_path, self.output_dir, self.settings,
+                            memory_budget=self.memory_budget, previous_digest=previous_digest,
+                            track_source=manifest is not None, batch=self.batch))
+                    if not pending:
+                        if self._cancelled.is_set() or stats.done >= stats.total:
+                            break
+                        # 暂停中：等待继续或取消
+                        self._running.wait(0.2)
+                        continue
+                    finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        result = future.result()
+                        if manifest is not None:
+                            manifest.record(result, settings_key)
+                        stats.add(result)
+                    if finished:
+                        self.events.put(("progress", stats.snapshot()))
+            self.events.put(("cancelled" if self._cancelled.is_set() else "done", stats.snapshot()))
+        except Exception as e:
+            self.events.put(("error", str(e)))
+        finally:
+            if manifest is not None:
+                try:
+                    manifest.save()
+                except OSError as e:
+                    self.events.put(("error", f"无法保存导出清单: {e}"))
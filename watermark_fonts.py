@@ -0,0 +1,187 @@
+"""系统字体索引：扫描一次系统字体目录并缓存到磁盘，按字体族名或所需字形（中日韩文字）查找字体"""
+import json
+import os
+import sys
+
+from PIL import ImageFont
+
+INDEX_VERSION = 1
+
+FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf', '.otc')
+
+# 用于判断字体是否覆盖某种文字的探测字符
+SCRIPT_PROBES = {
+    "zh": "中文水印",
+    "ja": "あア",
+    "ko": "한글",
+}
+
+# 几乎所有字体都不包含的码位，用来取 .notdef 字形做对比
+_MISSING_CHAR = "\U0010FFFD"
+
+# 单个 .ttc 文件最多读取的字体数
+MAX_FACES = 32
+
+
+def system_font_dirs():
+    """当前平台的系统字体目录"""
+    home = os.path.expanduser("~")
+    if sys.platform == "darwin":
+        return ["/System/Library/Fonts", "/Library/Fonts", os.path.join(home, "Library/Fonts")]
+    if sys.platform.startswith("win"):
+        dirs = [os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts")]
+        if os.environ.get("LOCALAPPDATA"):
+            dirs.append(os.path.join(os.environ["LOCALAPPDATA"], "Microsoft", "Windows", "Fonts"))
+        return dirs
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(home, ".local", "share")
+    return ["/usr/share/fonts", "/usr/local/share/fonts",
+            os.path.join(data_home, "fonts"), os.path.join(home, ".fonts")]
+
+
+def default_index_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "photo-watermark-tool", "font_index.json")
+
+
+def needed_scripts(text):
+    """文字中包含的中日韩文字种类"""
+    scripts = set()
+    for ch in text or "":
+        code = ord(ch)
+        if 0x3040 <= code <= 0x30FF:
+            scripts.add("ja")
+        elif 0xAC00 <= code <= 0xD7AF or 0x1100 <= code <= 0x11FF:
+            scripts.add("ko")
+        elif 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or 0xF900 <= code <= 0xFAFF:
+            scripts.add("zh")
+    return scripts
+
+
+def _has_glyphs(font, chars, notdef):
+    for ch in chars:
+        mask = font.getmask(ch)
+        if mask.getbbox() is None or bytes(mask) == notdef:
+            return False
+    return True
+
+
+def describe_face(path, index):
+    """读取单个字体的族名、样式和覆盖的文字，文件无效时抛出异常"""
+    font = ImageFont.truetype(path, 24, index=index)
+    family, style = font.getname()
+    notdef = bytes(font.getmask(_MISSING_CHAR))
+    scripts = [script for script, chars in SCRIPT_PROBES.items() if _has_glyphs(font, chars, notdef)]
+    return {"path": path, "index": index, "family": family or "", "style": style or "", "scripts": scripts}
+
+
+def describe_file(path):
+    """读取字体文件中的所有字体（.ttc 可能包含多个）"""
+    faces = []
+    count = MAX_FACES if path.lower().endswith(('.ttc', '.otc')) else 1
+    for index in range(count):
+        try:
+            faces.append(describe_face(path, index))
+        except Exception:
+            break
+    return faces
+
+
+class FontIndex:
+    """系统字体索引
+
+    扫描结果按目录 mtime 缓存在磁盘上：只要各字体目录没有增删文件，后续启动只需 stat 一遍目录。
+    """
+
+    def __init__(self, dirs=None, cache_path=None):
+        self.dirs = list(dirs) if dirs is not None else system_font_dirs()
+        self.cache_path = cache_path or default_index_path()
+        self.faces = []
+        self._dir_mtimes = {}
+
+    def load(self):
+        """读取磁盘缓存，缓存失效时重新扫描；返回 self 以便链式调用"""
+        if not self._load_cache():
+            self.rescan()
+        return self
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != INDEX_VERSION or data.get("roots") != self.dirs:
+            return False
+        # 新增或删除文件都会改变所在目录的 mtime；新增子目录会改变父目录的 mtime
+        for directory, mtime in data.get("dirs", {}).items():
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                return False
+        self.faces = data.get("faces", [])
+        self._dir_mtimes = data.get("dirs", {})
+        return True
+
+    def rescan(self):
+        faces = []
+        dir_mtimes = {}
+        for root in self.dirs:
+            if not os.path.isdir(root):
+                # 记录为不存在，目录以后被创建时缓存随之失效
+                dir_mtimes[root] = None
+                continue
+            for directory, _, files in os.walk(root):
+                try:
+                    dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                for name in sorted(files):
+                    if name.lower().endswith(FONT_EXTENSIONS):
+                        faces.extend(describe_file(os.path.join(directory, name)))
+        self.faces = faces
+        self._dir_mtimes = dir_mtimes
+        self._save_cache()
+
+    def _save_cache(self):
+        data = {"version": INDEX_VERSION, "roots": self.dirs, "dirs": self._dir_mtimes, "faces": self.faces}
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # 缓存写不进去只影响下次启动速度
+            pass
+
+    def families(self):
+        return sorted({face["family"] for face in self.faces if face["family"]})
+
+    def find(self, family=None, text=None):
+        """按族名和/或需要显示的文字查找字体，返回 (路径, 索引)，找不到时返回 None"""
+        candidates = self.faces
+        if family:
+            wanted = family.lower()
+            candidates = [face for face in candidates if face["family"].lower() == wanted]
+        scripts = needed_scripts(text)
+        if scripts:
+            candidates = [face for face in candidates if scripts.issubset(face["scripts"])]
+        if not candidates:
+            return None
+        # 优先常规字重
+        regular = [face for face in candidates if face["style"].lower() in ("regular", "book", "medium", "w3")]
+        face = (regular or candidates)[0]
+        return face["path"], face["index"]
+
+
+_default_index = None
+
+
+def default_font_index():
+    """进程内共享的字体索引（首次调用时从磁盘缓存加载）"""
+    global _default_index
+    if _default_index is None:
+        _default_index = FontIndex().load()
+    return _default_index
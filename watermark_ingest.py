@@ -0,0 +1,52 @@
+"""图片列表索引：保持添加顺序，用集合去重，增删的开销只与变化的条目数有关"""
+
+# 一次删除超过这个数量时改为单次遍历重建列表
+BULK_REMOVE_THRESHOLD = 64
+
+
+class ImageIndex:
+    """有序、去重的图片路径列表（可以像 list 一样按下标访问和遍历）"""
+
+    def __init__(self, paths=()):
+        self._paths = []
+        self._members = set()
+        self.add_many(paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, index):
+        return self._paths[index]
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __contains__(self, path):
+        return path in self._members
+
+    def add_many(self, paths):
+        """追加不在列表中的路径，返回实际新增的数量"""
+        added = 0
+        for path in paths:
+            if path not in self._members:
+                self._members.add(path)
+                self._paths.append(path)
+                added += 1
+        return added
+
+    def remove_indices(self, indices):
+        """按下标删除，返回被删除的路径"""
+        indices = sorted(set(indices))
+        removed = [self._paths[i] for i in indices]
+        if len(indices) > BULK_REMOVE_THRESHOLD:
+            drop = set(indices)
+            self._paths = [path for i, path in enumerate(self._paths) if i not in drop]
+        else:
+            for i in reversed(indices):
+                del self._paths[i]
+        self._members.difference_update(removed)
+        return removed
+
+    def clear(self):
+        self._paths.clear()
+        self._members.clear()
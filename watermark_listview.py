@@ -0,0 +1,137 @@
+"""虚拟化图片列表：Listbox 中只放可见的几十行，滚动时重新填充，列表长度不影响刷新开销"""
+import os
+import tkinter as tk
+
+
+class VirtualImageList(tk.Frame):
+    """按需显示 paths（支持 len 和下标访问的序列）的列表控件
+
+    选中状态按绝对下标保存；curselection() 与 tk.Listbox 的同名方法一样返回下标元组。
+    内容变化后调用 refresh()，只重新生成可见的行。
+    """
+
+    def __init__(self, master, paths, on_select=None, **listbox_options):
+        super().__init__(master)
+        self.paths = paths
+        self.on_select = on_select
+        self.first = 0  # 第一个可见行的下标
+        self.selected = set()
+        self.anchor = None  # Shift 多选的起点
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self, activestyle="none", exportselection=False, selectmode=tk.BROWSE,
+                                  **listbox_options)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.listbox.bind("<Configure>", lambda event: self.refresh())
+        self.listbox.bind("<Button-1>", self.on_click)
+        self.listbox.bind("<Shift-Button-1>", lambda event: self.on_click(event, extend=True))
+        self.listbox.bind("<Control-Button-1>", lambda event: self.on_click(event, toggle=True))
+        if self.tk.call("tk", "windowingsystem") == "aqua":
+            self.listbox.bind("<Command-Button-1>", lambda event: self.on_click(event, toggle=True))
+        self.listbox.bind("<B1-Motion>", lambda event: "break")
+        self.listbox.bind("<MouseWheel>", self.on_wheel)
+        self.listbox.bind("<Button-4>", lambda event: self.scroll_rows(-3))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll_rows(3))
+        self.listbox.bind("<Up>", lambda event: self.move_selection(-1))
+        self.listbox.bind("<Down>", lambda event: self.move_selection(1))
+        self.listbox.bind("<Prior>", lambda event: self.move_selection(-self.visible_rows()))
+        self.listbox.bind("<Next>", lambda event: self.move_selection(self.visible_rows()))
+
+    def visible_rows(self):
+        """可见行数（按行高估算）"""
+        height = self.listbox.winfo_height()
+        line = self.listbox.bbox(0)
+        row_height = line[3] + 1 if line else 18
+        return max(1, height // row_height + 1)
+
+    def refresh(self):
+        """重新填充可见的行（开销与可见行数成正比）"""
+        total = len(self.paths)
+        rows = self.visible_rows()
+        self.first = max(0, min(self.first, total - rows + 1))
+        last = min(total, self.first + rows)
+        self.listbox.delete(0, tk.END)
+        if last > self.first:
+            self.listbox.insert(tk.END, *(f"{i + 1}. {os.path.basename(self.paths[i])}"
+                                          for i in range(self.first, last)))
+        for i in range(self.first, last):
+            if i in self.selected:
+                self.listbox.selection_set(i - self.first)
+        if total:
+            self.scrollbar.set(self.first / total, last / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def curselection(self):
+        return tuple(sorted(self.selected))
+
+    def clear_selection(self):
+        self.selected.clear()
+        self.anchor = None
+
+    def select(self, index):
+        """选中第 index 项并滚动到可见位置"""
+        if not 0 <= index < len(self.paths):
+            return
+        self.selected = {index}
+        self.anchor = index
+        self.see(index)
+
+    def see(self, index):
+        rows = self.visible_rows()
+        if index < self.first:
+            self.first = index
+        elif index >= self.first + rows - 1:
+            self.first = index - rows + 2
+        self.refresh()
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self.first = int(float(amount) * len(self.paths))
+            self.refresh()
+        elif action == tk.SCROLL:
+            step = self.visible_rows() if unit == tk.PAGES else 1
+            self.scroll_rows(int(amount) * step)
+
+    def scroll_rows(self, delta):
+        self.first = max(0, self.first + delta)
+        self.refresh()
+        return "break"
+
+    def on_wheel(self, event):
+        # Windows 上 delta 是 120 的倍数，macOS 上是较小的整数
+        delta = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self.scroll_rows(-delta * 3)
+
+    def on_click(self, event, extend=False, toggle=False):
+        self.listbox.focus_set()
+        row = self.listbox.nearest(event.y)
+        index = self.first + row
+        if row < 0 or index >= len(self.paths):
+            return "break"
+        if extend and self.anchor is not None:
+            low, high = sorted((self.anchor, index))
+            self.selected = set(range(low, high + 1))
+        elif toggle:
+            self.selected.symmetric_difference_update({index})
+            self.anchor = index
+        else:
+            self.selected = {index}
+            self.anchor = index
+        self.refresh()
+        self._notify(index)
+        return "break"
+
+    def move_selection(self, delta):
+        if not len(self.paths):
+            return "break"
+        current = self.anchor if self.anchor is not None else -1 if delta > 0 else len(self.paths)
+        index = max(0, min(len(self.paths) - 1, current + delta))
+        self.select(index)
+        self._notify(index)
+        return "break"
+
+    def _notify(self, index):
+        if self.on_select is not None and index in self.selected:
+            self.on_select(index)
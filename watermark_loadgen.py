@@ -0,0 +1,186 @@
+"""HTTP 水印服务的压测脚本：多个保持连接的客户端并发请求，统计吞吐和延迟分位数
+
+示例:
+    python watermark_cli.py serve --port 8765 &
+    python watermark_loadgen.py http://127.0.0.1:8765 -c 8 -d 30
+    python watermark_loadgen.py http://127.0.0.1:8765 --image photo.jpg -n 500 --param layout=tiled
+"""
+import argparse
+import http.client
+import io
+import json
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from PIL import Image
+
+
+def synthetic_image(width, height, quality=90):
+    """生成一张有渐变的 JPEG（不依赖外部图片）"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+                                gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM)))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LoadGenerator:
+    """concurrency 个线程，每个线程一条保持的连接，循环发送同一个请求"""
+
+    def __init__(self, url, body, content_type="image/jpeg", params=None, concurrency=4, requests=None,
+                 duration=None, timeout=60):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.target = "/watermark" + (f"?{urlencode(params)}" if params else "")
+        self.body = body
+        self.content_type = content_type
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.latencies = []
+        self.statuses = {}
+        self.errors = []
+        self.bytes_received = 0
+
+    def take(self, deadline):
+        """领取一个请求名额；次数用完或到时间时返回 False"""
+        with self.lock:
+            if self.requests is not None and self.sent >= self.requests:
+                return False
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            self.sent += 1
+            return True
+
+    def client(self, deadline):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = {"Content-Type": self.content_type}
+        try:
+            while self.take(deadline):
+                start = time.perf_counter()
+                try:
+                    connection.request("POST", self.target, body=self.body, headers=headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    status = response.status
+                except (OSError, http.client.HTTPException) as e:
+                    # 连接被服务端关闭等情况：记录错误后重新连接
+                    connection.close()
+                    connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                    with self.lock:
+                        self.errors.append(str(e))
+                    continue
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.statuses[status] = self.statuses.get(status, 0) + 1
+                    if status == 200:
+                        self.latencies.append(elapsed)
+                        self.bytes_received += len(data)
+        finally:
+            connection.close()
+
+    def run(self):
+        start = time.perf_counter()
+        deadline = start + self.duration if self.duration else None
+        threads = [threading.Thread(target=self.client, args=(deadline,), daemon=True)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+
+        return {
+            "concurrency": self.concurrency,
+            "requests": self.sent,
+            "ok": len(latencies),
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "errors": len(self.errors),
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+            "mb_per_second": round(self.bytes_received / elapsed / (1024 * 1024), 2) if elapsed > 0 else None,
+            "latency_ms": {
+                "mean": ms(statistics.fmean(latencies)) if latencies else None,
+                "p50": ms(percentile(latencies, 0.5)),
+                "p90": ms(percentile(latencies, 0.9)),
+                "p99": ms(percentile(latencies, 0.99)),
+                "max": ms(latencies[-1] if latencies else None),
+            },
+        }
+
+
+def parse_param(value):
+    name, sep, setting = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"应为 名称=值: {value}")
+    return name, setting
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="HTTP 水印服务压测")
+    parser.add_argument("url", help="服务地址，如 http://127.0.0.1:8765")
+    parser.add_argument("--image", help="上传的图片（默认生成一张合成 JPEG）")
+    parser.add_argument("--size", default="2000x1500", help="合成图片的尺寸（宽x高）")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="并发连接数")
+    parser.add_argument("-n", "--requests", type=int, default=None, help="总请求数")
+    parser.add_argument("-d", "--duration", type=float, default=None, help="持续时间（秒）；与 -n 都不指定时为 10 秒")
+    parser.add_argument("--warmup", type=int, default=None, help="正式计时前的预热请求数（默认等于并发数）")
+    parser.add_argument("--param", type=parse_param, action="append", default=[], metavar="名称=值",
+                        help="水印参数，如 --param text=样片 --param layout=tiled（可重复）")
+    parser.add_argument("-o", "--output", help="保存结果的 JSON 文件")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.image:
+        with open(args.image, "rb") as f:
+            body = f.read()
+        content_type = "image/png" if args.image.lower().endswith(".png") else "image/jpeg"
+    else:
+        width, height = (int(v) for v in args.size.lower().split("x"))
+        body, content_type = synthetic_image(width, height), "image/jpeg"
+    duration = args.duration if args.duration or args.requests else 10.0
+    params = dict(args.param)
+
+    # 预热：让每个工作进程都加载好字体和水印缓存
+    warmup = args.concurrency if args.warmup is None else args.warmup
+    if warmup:
+        LoadGenerator(args.url, body, content_type, params, args.concurrency, requests=warmup).run()
+
+    report = LoadGenerator(args.url, body, content_type, params, args.concurrency, args.requests, duration).run()
+    latency = report["latency_ms"]
+    print(f"{report['ok']}/{report['requests']} 成功，{report['requests_per_second']} 请求/秒，"
+          f"延迟 p50 {latency['p50']}ms  p90 {latency['p90']}ms  p99 {latency['p99']}ms  最大 {latency['max']}ms",
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    return 0 if report["ok"] == report["requests"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""增量导出清单：记录每个源文件的大小、mtime、内容哈希、水印参数哈希以及生成的输出
+
+清单保存在输出文件夹中。重新导出时跳过未变化的文件；每完成一张就追加写入日志，
+导出中断后再次运行可以从断点继续。
+"""
+import hashlib
+import json
+import os
+import threading
+from dataclasses import asdict
+
+MANIFEST_NAME = ".watermark_manifest.json"
+JOURNAL_NAME = ".watermark_manifest.journal"
+MANIFEST_VERSION = 1
+
+# 渲染逻辑变化导致输出不同时递增，使旧清单全部失效
+RENDER_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def settings_hash(settings):
+    """水印参数的哈希（参数、图片水印文件或渲染版本变化时输出需要重新生成）"""
+    logo = None
+    if settings.logo_path:
+        try:
+            stat = os.stat(settings.logo_path)
+            logo = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            pass
+    payload = json.dumps({"render": RENDER_VERSION, "settings": asdict(settings), "logo": logo}, sort_keys=True,
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    """分块计算文件内容哈希（不把整个文件读进内存）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_key(path):
+    return os.path.abspath(path)
+
+
+class ExportManifest:
+    """某个输出文件夹的导出清单"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.journal_path = os.path.join(output_dir, JOURNAL_NAME)
+        self.entries = {}
+        self._journal = None
+
+    def load(self):
+        """读取清单并重放上次中断时留下的日志；返回 self 以便链式调用"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("entries", {})
+        except (OSError, ValueError):
+            self.entries = {}
+        try:
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 中断时最后一行可能没写完
+                        continue
+                    self.entries[record.pop("source")] = record
+        except OSError:
+            pass
+        return self
+
+    def is_current(self, entry, stat, settings_key):
+        """清单记录与源文件（大小、mtime）、参数一致，且输出文件仍在"""
+        if entry is None or entry.get("settings") != settings_key:
+            return False
+        if entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+            return False
+        return self.output_intact(entry)
+
+    def output_intact(self, entry):
+        try:
+            return os.stat(os.path.join(self.output_dir, entry["output"])).st_size == entry.get("output_size")
+        except (OSError, KeyError):
+            return False
+
+    def plan(self, paths, settings_key, force=False):
+        """把输入分成 (需要处理的 [(路径, 上次的内容哈希)], 可跳过的 [路径])
+
+        大小或 mtime 变了但参数没变时带上上次的哈希，由工作进程比对内容后决定是否真的重新渲染。
+        """
+        todo, skipped = [], []
+        for path in paths:
+            entry = self.entries.get(source_key(path))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                todo.append((path, None))
+                continue
+            if not force and self.is_current(entry, stat, settings_key):
+                skipped.append(path)
+            elif not force and entry and entry.get("settings") == settings_key and self.output_intact(entry):
+                todo.append((path, entry.get("digest")))
+            else:
+                todo.append((path, None))
+        return todo, skipped
+
+    def record(self, result, settings_key):
+        """记录一个成功的结果（追加到日志，中断后可恢复）"""
+        if not result.get("ok"):
+            return
+        output_name = os.path.basename(result["output"])
+        entry = {
+            "size": result["size"],
+            "mtime_ns": result["mtime_ns"],
+            "digest": result["digest"],
+            "settings": settings_key,
+            "output": output_name,
+            "output_size": os.stat(os.path.join(self.output_dir, output_name)).st_size,
+        }
+        key = source_key(result["source"])
+        self.entries[key] = entry
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps({"source": key, **entry}, ensure_ascii=False) + "\n")
+        self._journal.flush()
+
+    def save(self):
+        """把日志合并进清单（原子替换），然后清空日志"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
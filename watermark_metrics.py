@@ -0,0 +1,301 @@
+"""渲染管线的运行指标：各阶段耗时直方图、计数器、读写字节数、缓存命中率
+
+默认关闭，关闭时 stage()/count() 只有一次属性判断的开销。开启后：
+
+    with metrics.stage("decode"):
+        ...
+
+可选按图片启用 cProfile（每张图片一个 .prof 文件）和 tracemalloc（记录每张图片的内存分配峰值）。
+多进程导出时各工作进程的指标随结果返回，在主进程中合并；汇总可导出为 JSON 或 Prometheus 文本格式。
+"""
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# 耗时直方图的上界（秒），与 Prometheus 的 le 语义一致
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 内存分配峰值直方图的上界（字节）
+BYTE_BUCKETS = tuple(2 ** n for n in range(20, 34, 2))
+
+METRIC_PREFIX = "watermark"
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一格是 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, data):
+        if tuple(data["buckets"]) != self.buckets:
+            raise ValueError("直方图的分桶不一致，无法合并")
+        self.counts = [a + b for a, b in zip(self.counts, data["counts"])]
+        self.sum += data["sum"]
+        self.count += data["count"]
+        self.max = max(self.max, data["max"])
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count,
+                "max": self.max}
+
+
+class _NullContext:
+    """关闭指标时 stage() 返回的共享空上下文"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _ImageScope:
+    """单张图片的计时，以及可选的 cProfile / tracemalloc"""
+
+    def __init__(self, metrics, label):
+        self.metrics = metrics
+        self.label = label
+        self.profiler = None
+
+    def __enter__(self):
+        if self.metrics.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.metrics.profile_dir:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe("image", time.perf_counter() - self.start)
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.metrics.profile_path(self.label))
+        if self.metrics.trace_memory:
+            import tracemalloc
+            self.metrics.observe("image_peak_alloc_bytes", tracemalloc.get_traced_memory()[1], BYTE_BUCKETS)
+        return False
+
+
+class Metrics:
+    """进程内的指标登记表（线程安全）"""
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_dir = None
+        self.trace_memory = False
+        self._lock = threading.RLock()
+        self._cache_sources = {}
+        self.reset()
+
+    def configure(self, enabled=True, profile_dir=None, trace_memory=False):
+        self.enabled = enabled
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def config(self):
+        """当前配置（传给工作进程的 configure）"""
+        return {"enabled": self.enabled, "profile_dir": self.profile_dir, "trace_memory": self.trace_memory}
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.caches = {}
+            # 缓存的计数是进程累计值，记下当前值，之后只统计增量
+            self._cache_base = {name: source() for name, source in self._cache_sources.items()}
+
+    def register_cache(self, name, source):
+        """登记一个缓存：source() 返回 (命中次数, 未命中次数)，functools.lru_cache 可用 lru_cache_source"""
+        with self._lock:
+            self._cache_sources[name] = source
+            self._cache_base[name] = source()
+
+    def stage(self, name):
+        """计时上下文：with metrics.stage("encode"): ..."""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def image(self, label):
+        """单张图片的处理范围（总耗时，开启时按图片做 cProfile / tracemalloc）"""
+        if not self.enabled:
+            return _NULL
+        return _ImageScope(self, label)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def profile_path(self, label):
+        name = re.sub(r"[^\w.-]+", "_", os.path.basename(label)) or "image"
+        return os.path.join(self.profile_dir, f"{name}.{os.getpid()}.{threading.get_ident()}.prof")
+
+    def snapshot(self):
+        """可序列化的原始数据（可以用 merge 合并到另一个进程的登记表）"""
+        with self._lock:
+            caches = {name: list(counts) for name, counts in self.caches.items()}
+            for name, source in self._cache_sources.items():
+                hits, misses = source()
+                base_hits, base_misses = self._cache_base.get(name, (0, 0))
+                merged = caches.setdefault(name, [0, 0])
+                merged[0] += hits - base_hits
+                merged[1] += misses - base_misses
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: h.to_dict() for name, h in self.histograms.items()},
+                "caches": caches,
+            }
+
+    def drain(self):
+        """取出当前数据并清零（工作进程每处理完一张图片调用一次）"""
+        with self._lock:
+            data = self.snapshot()
+            self.reset()
+            return data
+
+    def merge(self, data):
+        with self._lock:
+            for name, value in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, values in data["histograms"].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram(values["buckets"])
+                histogram.merge(values)
+            for name, (hits, misses) in data["caches"].items():
+                merged = self.caches.setdefault(name, [0, 0])
+                merged[0] += hits
+                merged[1] += misses
+
+    def summary(self):
+        """运行汇总（JSON）：各阶段次数、总耗时、平均值、估算分位数，计数器和缓存命中率"""
+        data = self.snapshot()
+        stages = {}
+        for name, values in data["histograms"].items():
+            count = values["count"]
+            stages[name] = {
+                "count": count,
+                "sum": round(values["sum"], 6),
+                "mean": round(values["sum"] / count, 6) if count else None,
+                "p50": _bucket_quantile(values, 0.5),
+                "p90": _bucket_quantile(values, 0.9),
+                "p99": _bucket_quantile(values, 0.99),
+                "max": round(values["max"], 6),
+                "buckets": dict(zip([*map(str, values["buckets"]), "+Inf"], values["counts"])),
+            }
+        caches = {}
+        for name, (hits, misses) in data["caches"].items():
+            total = hits + misses
+            caches[name] = {"hits": hits, "misses": misses, "hit_rate": round(hits / total, 4) if total else None}
+        return {"stages": stages, "counters": data["counters"], "caches": caches}
+
+    def to_prometheus(self):
+        """Prometheus 文本格式"""
+        data = self.snapshot()
+        lines = []
+        for name, value in sorted(data["counters"].items()):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, values in sorted(data["histograms"].items()):
+            unit = "bytes" if name.endswith("_bytes") else "seconds"
+            metric = f"{METRIC_PREFIX}_{name.removesuffix('_bytes')}_{unit}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip([*values["buckets"], "+Inf"], values["counts"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f"{metric}_sum {values['sum']}", f"{metric}_count {values['count']}"]
+        for kind, index in (("hits", 0), ("misses", 1)):
+            metric = f"{METRIC_PREFIX}_cache_{kind}_total"
+            if data["caches"]:
+                lines.append(f"# TYPE {metric} counter")
+            for name, counts in sorted(data["caches"].items()):
+                lines.append(f'{metric}{{cache="{name}"}} {counts[index]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, fmt=None):
+        """保存汇总；fmt 为 "json" 或 "prometheus"，默认按扩展名（.prom/.txt 为 Prometheus）"""
+        if fmt is None:
+            fmt = "prometheus" if path.endswith((".prom", ".txt")) else "json"
+        with open(path, "w", encoding="utf-8") as f:
+            if fmt == "prometheus":
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+
+def _bucket_quantile(values, q):
+    """按直方图估算分位数（取所在分桶的上界，落在 +Inf 桶时取最大值）"""
+    if not values["count"]:
+        return None
+    rank = q * values["count"]
+    cumulative = 0
+    for bound, count in zip(values["buckets"], values["counts"]):
+        cumulative += count
+        if cumulative >= rank:
+            return min(bound, values["max"])
+    return values["max"]
+
+
+def lru_cache_source(func):
+    """把 functools.lru_cache 的统计转换成 (命中, 未命中)"""
+    def source():
+        info = func.cache_info()
+        return info.hits, info.misses
+    return source
+
+
+def configure_worker(config):
+    """进程池的 initializer：在工作进程中沿用主进程的指标配置"""
+    metrics.configure(**config)
+
+
+# 进程内共享的登记表
+metrics = Metrics()
@@ -0,0 +1,162 @@
+"""流水线导出：预读、渲染、编码三个阶段并行，I/O 与 CPU 重叠
+
+    预读线程（读文件字节） -> 有界队列 -> 渲染线程（解码 + 加水印） -> 有界队列 -> 编码线程（编码 + 写文件)
+
+Pillow 在解码、合成和编码时释放 GIL，所以各阶段用线程即可真正并行。队列有上限：
+后面的阶段跟不上时前面的阶段会阻塞等待，内存中同时存在的解码后图片数量是固定的。
+"""
+import threading
+import time
+from queue import Queue
+
+from watermark_batch import add_watermark_batched
+from watermark_engine import render_file, save_output
+from watermark_export import count_result, error_message, mark_unchanged, new_result, read_source
+from watermark_metrics import metrics
+from watermark_stream import should_stream, watermark_file_streaming
+
+DEFAULT_IO_THREADS = 4
+
+_DONE = object()
+
+
+class ExportPipeline:
+    """分阶段的导出流水线（结果记录与 export_one 相同）"""
+
+    def __init__(self, output_dir, settings, io_threads=DEFAULT_IO_THREADS, render_threads=1, encode_threads=1,
+                 memory_budget=None, track_source=False, batch=False):
+        self.output_dir = output_dir
+        self.settings = settings
+        self.io_threads = max(1, io_threads)
+        self.render_threads = max(1, render_threads)
+        self.encode_threads = max(1, encode_threads)
+        self.memory_budget = memory_budget
+        self.track_source = track_source
+        self.watermark = add_watermark_batched if batch else None
+        # 预读队列存放压缩的文件字节，编码队列存放解码后的整图，后者尽量短
+        self.read_queue = Queue(maxsize=self.io_threads * 2)
+        self.encode_queue = Queue(maxsize=self.encode_threads)
+        self.done_queue = Queue()
+        self._stop = threading.Event()
+
+    def run(self, paths, previous_digests=None, progress=None):
+        """处理全部图片，按输入顺序返回结果记录；progress(result, 已完成数, 总数) 按完成顺序调用"""
+        total = len(paths)
+        previous_digests = previous_digests or [None] * total
+        items = iter(enumerate(zip(paths, previous_digests)))
+        items_lock = threading.Lock()
+
+        def next_item():
+            with items_lock:
+                return None if self._stop.is_set() else next(items, None)
+
+        threads = (
+            self._stage(self.io_threads, self._read_worker, next_item, self.read_queue, self.render_threads)
+            + self._stage(self.render_threads, self._render_worker, None, self.encode_queue, self.encode_threads)
+            + self._stage(self.encode_threads, self._encode_worker, None, None, 0)
+        )
+        report = [None] * total
+        done = 0
+        try:
+            while done < total:
+                index, result = self.done_queue.get()
+                report[index] = result
+                done += 1
+                if progress:
+                    progress(result, done, total)
+        finally:
+            # 中断时让预读停止取新图片，已在途的图片由后续阶段丢弃
+            self._stop.set()
+        for thread in threads:
+            thread.join()
+        return report
+
+    def _stage(self, count, worker, source, output, downstream):
+        """启动一个阶段的线程；最后一个退出的线程向下游每个线程发送结束标记"""
+        remaining = [count]
+        lock = threading.Lock()
+
+        def run():
+            try:
+                worker(source)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    for _ in range(downstream):
+                        output.put(_DONE)
+
+        threads = [threading.Thread(target=run, name=f"export-{worker.__name__.strip('_')}-{i}", daemon=True)
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _finish(self, index, result, start):
+        result["seconds"] = round(time.perf_counter() - start, 4)
+        if metrics.enabled:
+            metrics.observe("image", time.perf_counter() - start)
+            count_result(result["source"], result)
+        self.done_queue.put((index, result))
+
+    def _read_worker(self, next_item):
+        while True:
+            item = next_item()
+            if item is None:
+                return
+            index, (image_path, previous_digest) = item
+            start = time.perf_counter()
+            result = new_result(image_path)
+            try:
+                # 按文件头判断是否超出内存预算：文件本身很小、解码后很大的图片（如压缩的 TIFF）也要流式处理
+                streaming = bool(self.memory_budget) and should_stream(image_path, self.memory_budget)
+                source = read_source(image_path, result, self.memory_budget, self.track_source, prefetch=True,
+                                     streaming=streaming)
+            except Exception as e:
+                result["error"] = error_message(image_path, e)
+                self._finish(index, result, start)
+                continue
+            if mark_unchanged(result, self.output_dir, previous_digest):
+                self._finish(index, result, start)
+                continue
+            self.read_queue.put((index, result, source, streaming, start))
+
+    def _render_worker(self, _):
+        while True:
+            item = self.read_queue.get()
+            if item is _DONE:
+                return
+            index, result, source, streaming, start = item
+            image_path = result["source"]
+            try:
+                if self._stop.is_set():
+                    raise RuntimeError("导出已中断")
+                if streaming:
+                    # 超出预算的大图按条带流式处理，直接写出，不进入编码队列
+                    with metrics.stage("stream"):
+                        result.update(output=watermark_file_streaming(image_path, self.output_dir, self.settings,
+                                                                      self.memory_budget), ok=True)
+                    self._finish(index, result, start)
+                    continue
+                image = render_file(image_path, self.settings, source, self.watermark)
+            except Exception as e:
+                result["error"] = error_message(image_path, e)
+                self._finish(index, result, start)
+                continue
+            self.encode_queue.put((index, result, image, start))
+
+    def _encode_worker(self, _):
+        while True:
+            item = self.encode_queue.get()
+            if item is _DONE:
+                return
+            index, result, image, start = item
+            try:
+                if self._stop.is_set():
+                    raise RuntimeError("导出已中断")
+                result.update(output=save_output(image, result["source"], self.output_dir), ok=True)
+            except Exception as e:
+                result["error"] = error_message(result["source"], e)
+            del image
+            self._finish(index, result, start)
@@ -0,0 +1,192 @@
+"""预览管线：缓存预览分辨率的缩略图（proxy），设置变化时只需重新叠加水印"""
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from watermark_engine import normalize_mode
+
+# 默认内存上限
+DEFAULT_PROXY_CACHE_BYTES = 256 * 1024 * 1024
+
+# JPEG 解码器能直接按 1/2、1/4、1/8 缩小解码
+JPEG_DRAFT_FACTORS = (1, 2, 4, 8)
+
+
+def reduce_factor_for(original_size, target_size):
+    """在不小于目标尺寸的前提下，能缩小的最大 2 的幂倍数"""
+    width, height = original_size
+    target_width, target_height = max(1, target_size[0]), max(1, target_size[1])
+    factor = 1
+    while width // (factor * 2) >= target_width and height // (factor * 2) >= target_height:
+        factor *= 2
+    return factor
+
+
+def decode_reduced(path, factor):
+    """按 factor 缩小解码图片：JPEG 用 draft 在解码阶段直接缩小，其他格式解码后 reduce"""
+    with Image.open(path) as image:
+        width, height = image.size
+        if image.format == "JPEG" and factor > 1:
+            draft_factor = max(f for f in JPEG_DRAFT_FACTORS if f <= factor)
+            image.draft("RGB", (-(-width // draft_factor), -(-height // draft_factor)))
+        image.load()
+        remaining = max(1, round(image.width / max(1, width // factor)))
+        proxy = image.reduce(remaining) if remaining > 1 else image.copy()
+    return normalize_mode(proxy), (width, height)
+
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class ProxyCache:
+    """预览缩略图的 LRU 缓存
+
+    以 (路径, mtime, 缩小倍数) 为键，总内存超过 max_bytes 时淘汰最久未用的缩略图。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PROXY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}  # 路径 -> (mtime, 原图尺寸)，随该路径的最后一张缩略图一起淘汰
+        self._lock = threading.Lock()
+
+    def original_size(self, path):
+        """原图尺寸（只读文件头，不解码）"""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._sizes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with Image.open(path) as image:
+            size = image.size
+        self._sizes[path] = (mtime, size)
+        return size
+
+    def get(self, path, target_size):
+        """返回 (不小于 target_size 的缩略图, 原图尺寸)；返回的图片是共享的，调用方不得修改"""
+        original_size = self.original_size(path)
+        factor = reduce_factor_for(original_size, target_size)
+        return self.get_reduced(path, factor), original_size
+
+    def get_reduced(self, path, factor):
+        """返回按 factor 缩小的图片（factor=1 即原图）；返回的图片是共享的，调用方不得修改"""
+        key = (path, os.stat(path).st_mtime_ns, factor)
+        with self._lock:
+            proxy = self._entries.get(key)
+            if proxy is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return proxy
+            self.misses += 1
+
+        proxy, _ = decode_reduced(path, factor)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = proxy
+                self.current_bytes += image_bytes(proxy)
+                self._evict()
+        return proxy
+
+    def _evict(self):
+        # 至少保留最新的一项，即使它单独就超过上限
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            (path, _, _), proxy = self._entries.popitem(last=False)
+            self.current_bytes -= image_bytes(proxy)
+            if not any(key[0] == path for key in self._entries):
+                self._sizes.pop(path, None)
+
+    def discard(self, path):
+        """移除某个文件的全部缩略图（例如从列表中删除后）"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self.current_bytes -= image_bytes(self._entries.pop(key))
+            self._sizes.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.current_bytes = 0
+
+
+class PreviewScheduler:
+    """合并预览请求并在后台线程渲染
+
+    request() 只保留最新一次请求（按代号递增），工作线程总是渲染最新的请求；
+    渲染完成时若已有更新的请求，结果直接丢弃。结果通过 after 轮询交回主线程，
+    画布只在主线程中更新（Tk 不是线程安全的）。
+    """
+
+    def __init__(self, render, deliver, after, on_error=None, poll_ms=15):
+        self.render = render  # 工作线程中调用：render(job) -> result
+        self.deliver = deliver  # 主线程中调用：deliver(job, result)
+        self.on_error = on_error  # 主线程中调用：on_error(job, exception)
+        self.after = after  # 通常是 window.after
+        self.poll_ms = poll_ms
+        self.generation = 0
+        self._pending = None
+        self._done = None
+        self._busy = False
+        self._polling = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name="preview-render", daemon=True)
+        self._thread.start()
+
+    def request(self, job):
+        """提交新的预览任务（主线程调用），之前尚未开始的任务被直接替换"""
+        with self._lock:
+            self.generation += 1
+            self._pending = (self.generation, job)
+        self._wakeup.set()
+        if not self._polling:
+            self._polling = True
+            self.after(self.poll_ms, self._poll)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+
+    def _worker(self):
+        while True:
+            self._wakeup.wait()
+            if self._closed:
+                return
+            with self._lock:
+                self._wakeup.clear()
+                pending, self._pending = self._pending, None
+                self._busy = pending is not None
+            if pending is None:
+                continue
+            generation, job = pending
+            try:
+                outcome = (True, self.render(job))
+            except Exception as e:
+                outcome = (False, e)
+            with self._lock:
+                self._busy = False
+                # 期间有新的请求时丢弃这次结果
+                if generation == self.generation:
+                    self._done = (generation, job, outcome)
+
+    def _poll(self):
+        with self._lock:
+            done, self._done = self._done, None
+            idle = not self._busy and self._pending is None
+        if done is not None:
+            generation, job, (ok, value) = done
+            if generation == self.generation:
+                if ok:
+                    self.deliver(job, value)
+                elif self.on_error:
+                    self.on_error(job, value)
+        if self._closed or (idle and done is None):
+            self._polling = False
+            return
+        self.after(self.poll_ms, self._poll)
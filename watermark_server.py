@@ -0,0 +1,354 @@
+"""本地 HTTP 水印服务：其他工具通过 HTTP 请求加水印，不需要调用桌面程序
+
+    python watermark_cli.py serve --port 8765 --text "© 2024" --allow-root /mnt/photos
+
+    POST /watermark?text=...&opacity=...   请求体是图片，返回加了水印的图片
+    POST /watermark                        Content-Type: application/json，{"path": ..., "settings": {...}}
+                                           处理共享存储上的文件（只允许 --allow-root 下的路径）
+    GET  /healthz                          运行状态（JSON）
+    GET  /metrics                          运行指标（Prometheus 文本格式）
+
+渲染在常驻的进程池中进行，与 export 使用同一套渲染逻辑。同时处理的请求数有上限，超出的请求排队，
+排队的请求数也超出上限时直接返回 503。连接默认保持（HTTP/1.1 keep-alive），结果分块（chunked）写回。
+"""
+import io
+import json
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from PIL import Image, UnidentifiedImageError
+
+from watermark_batch import add_watermark_batched
+from watermark_engine import check_setting, render_file, save_image
+from watermark_export import ignore_interrupts
+from watermark_metrics import METRIC_PREFIX, configure_worker, metrics
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUE = 64
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# 请求中可以覆盖的水印参数（字体和图片水印文件只能在启动服务时指定）
+OVERRIDABLE = ("text", "color", "font_size", "opacity", "position", "layout", "tile_angle", "tile_spacing",
+               "tile_stagger", "logo_scale", "logo_position")
+FORMATS = {"jpeg": (".jpg", "image/jpeg"), "jpg": (".jpg", "image/jpeg"), "png": (".png", "image/png")}
+
+
+class RequestError(Exception):
+    """请求无法处理；status 是返回的 HTTP 状态码"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def settings_with_overrides(settings, overrides):
+    """在服务的默认参数上应用请求中的参数（查询字符串中的值是字符串，按字段类型转换）"""
+    changes = {}
+    for name, value in overrides.items():
+        if name not in OVERRIDABLE:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"不支持的参数: {name}")
+        try:
+            changes[name] = check_setting(name, value)
+        except ValueError as e:
+            raise RequestError(HTTPStatus.BAD_REQUEST, str(e)) from None
+    return settings.with_changes(**changes) if changes else settings
+
+
+def render_request(data, path, settings, fmt=None):
+    """在工作进程中渲染一个请求，返回 (图片字节, Content-Type, 工作进程的指标)
+
+    data 是上传的图片字节，为 None 时读取 path；fmt 为空时沿用原图格式（PNG 输出 PNG，其他输出 JPEG）。
+    """
+    source = io.BytesIO(data) if data is not None else None
+    if fmt is None:
+        if source is None:
+            fmt = "png" if os.path.splitext(path)[1].lower() == ".png" else "jpeg"
+        else:
+            with Image.open(source) as probe:
+                fmt = "png" if probe.format == "PNG" else "jpeg"
+            source.seek(0)
+    ext, content_type = FORMATS[fmt]
+    image = render_file(path, settings, source, add_watermark_batched)
+    buffer = io.BytesIO()
+    with metrics.stage("encode"):
+        save_image(image, buffer, ext)
+    return buffer.getvalue(), content_type, metrics.drain() if metrics.enabled else None
+
+
+def _init_worker(config):
+    """工作进程的 initializer：沿用主进程的指标配置
+
+    工作进程在 serve() 安装 SIGTERM 处理函数之后才按需创建，会继承它；这里恢复默认处理，
+    并忽略 Ctrl+C，工作进程只在主进程关闭进程池时退出。
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ignore_interrupts()
+    configure_worker(config)
+
+
+class WatermarkService:
+    """进程池和并发控制（与 HTTP 无关，可以单独使用）
+
+    同时交给进程池的请求最多 max_concurrency 个（默认是工作进程数的 2 倍，进程处理完一个马上有下一个），
+    其余的在线程中等待；等待的请求超过 max_queue 个时新请求直接被拒绝。
+    """
+
+    def __init__(self, settings, workers=None, max_concurrency=None, max_queue=DEFAULT_MAX_QUEUE,
+                 allowed_roots=()):
+        self.settings = settings
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrency = max_concurrency or self.workers * 2
+        self.max_queue = max_queue
+        self.allowed_roots = [os.path.realpath(root) for root in allowed_roots]
+        self.slots = threading.Semaphore(self.max_concurrency)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.started = time.monotonic()
+        self.executor = None
+        self.broken = False  # 进程池坏了、还没换好
+        self.pool_restarts = 0
+
+    def start(self):
+        metrics.configure()
+        self.executor = self.new_executor()
+        return self
+
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(metrics.config(),))
+
+    def restart_pool(self, broken):
+        """有工作进程异常退出（如内存不足被杀掉）后整个进程池都不能再用，换一个新的
+
+        多个请求同时发现时只换一次；新进程池能处理任务后才恢复健康状态，换不成功时由下一个请求再换。
+        """
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.broken = True
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.new_executor()
+            self.pool_restarts += 1
+            try:
+                self.executor.submit(os.getpid).result()
+            except BrokenProcessPool:
+                return
+            self.broken = False
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def resolve_path(self, path):
+        """共享存储上的路径只允许位于 allowed_roots 之下"""
+        real = os.path.realpath(path)
+        if not any(real == root or real.startswith(root + os.sep) for root in self.allowed_roots):
+            raise RequestError(HTTPStatus.FORBIDDEN, "不允许访问该路径（启动服务时用 --allow-root 指定允许的文件夹）")
+        if not os.path.isfile(real):
+            raise RequestError(HTTPStatus.NOT_FOUND, f"文件不存在: {path}")
+        return real
+
+    def render(self, data=None, path=None, overrides=None, fmt=None):
+        """渲染一个请求，返回 (图片字节, Content-Type)；出错时抛出 RequestError"""
+        if fmt is not None and fmt not in FORMATS:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"不支持的输出格式: {fmt}")
+        settings = settings_with_overrides(self.settings, overrides or {})
+        if data is None:
+            if not path:
+                raise RequestError(HTTPStatus.BAD_REQUEST, "需要上传图片或指定 path")
+            path = self.resolve_path(path)
+        with self.lock:
+            if self.queued >= self.max_queue:
+                metrics.count("requests_rejected")
+                raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "服务繁忙，请稍后重试")
+            self.queued += 1
+        self.slots.acquire()
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        executor = self.executor
+        try:
+            with metrics.stage("render"):
+                body, content_type, worker_metrics = executor.submit(
+                    render_request, data, path, settings, fmt).result()
+        except BrokenProcessPool:
+            self.restart_pool(executor)
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "工作进程异常退出（可能内存不足），请稍后重试") from None
+        except UnidentifiedImageError:
+            raise RequestError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "无法识别的图片格式") from None
+        except OSError as e:
+            raise RequestError(HTTPStatus.UNPROCESSABLE_ENTITY, f"图片处理失败: {e}") from None
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+        if worker_metrics:
+            metrics.merge(worker_metrics)
+        metrics.count("bytes_written", len(body))
+        return body, content_type
+
+    def health(self):
+        with self.lock:
+            active, queued, broken = self.active, self.queued, self.broken
+        return {"status": "unhealthy" if broken else "ok", "workers": self.workers,
+                "max_concurrency": self.max_concurrency, "max_queue": self.max_queue, "active": active,
+                "queued": queued, "pool_restarts": self.pool_restarts,
+                "uptime_seconds": round(time.monotonic() - self.started, 1)}
+
+    def prometheus(self):
+        health = self.health()
+        text = metrics.to_prometheus().rstrip("\n")
+        lines = [text] if text else []
+        for name in ("active", "queued"):
+            metric = f"{METRIC_PREFIX}_requests_{name}"
+            lines += [f"# TYPE {metric} gauge", f"{metric} {health[name]}"]
+        return "\n".join(lines) + "\n"
+
+
+class WatermarkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 默认保持连接
+    server_version = "photo-watermark"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def do_GET(self):
+        route = urlsplit(self.path).path
+        if route == "/healthz":
+            health = self.service.health()
+            status = HTTPStatus.OK if health["status"] == "ok" else HTTPStatus.SERVICE_UNAVAILABLE
+            self.send_body(status, json.dumps(health).encode("utf-8"), "application/json")
+        elif route == "/metrics":
+            self.send_body(HTTPStatus.OK, self.service.prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, "未知的地址")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/watermark":
+            self.send_error_json(HTTPStatus.NOT_FOUND, "未知的地址")
+            return
+        start = time.perf_counter()
+        metrics.count("requests")
+        try:
+            query = dict(parse_qsl(url.query))
+            fmt = query.pop("format", None)
+            body = self.read_body()
+            if self.headers.get_content_type() == "application/json":
+                try:
+                    request = json.loads(body)
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    raise RequestError(HTTPStatus.BAD_REQUEST, "请求体应为 JSON 对象")
+                settings = request.get("settings", {})
+                if not isinstance(settings, dict):
+                    raise RequestError(HTTPStatus.BAD_REQUEST, "settings 应为 JSON 对象")
+                overrides = {**query, **settings}
+                result = self.service.render(path=request.get("path"), overrides=overrides,
+                                             fmt=request.get("format", fmt))
+            else:
+                result = self.service.render(data=body, path=query.pop("path", None) if not body else None,
+                                             overrides=query, fmt=fmt)
+        except RequestError as e:
+            metrics.count("requests_failed")
+            self.send_error_json(e.status, str(e))
+            return
+        except Exception as e:
+            metrics.count("requests_failed")
+            self.send_error_json(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+            return
+        self.send_stream(HTTPStatus.OK, *result)
+        metrics.observe("request", time.perf_counter() - start)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.close_connection = True
+            raise RequestError(HTTPStatus.LENGTH_REQUIRED, "需要 Content-Length")
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_UPLOAD_BYTES:
+            # 不读请求体，直接断开连接
+            self.close_connection = True
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"上传的文件超过 {MAX_UPLOAD_BYTES // 1024 // 1024}MB")
+        chunks = []
+        remaining = length
+        while remaining:
+            chunk = self.rfile.read(min(remaining, READ_CHUNK_SIZE))
+            if not chunk:
+                self.close_connection = True
+                raise RequestError(HTTPStatus.BAD_REQUEST, "请求体不完整")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        if metrics.enabled:
+            metrics.count("bytes_read", length)
+        return b"".join(chunks)
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, status, body, content_type):
+        """分块写回（不需要再复制一份完整的响应，客户端可以边收边处理）"""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        view = memoryview(body)
+        for start in range(0, len(view), STREAM_CHUNK_SIZE):
+            chunk = view[start:start + STREAM_CHUNK_SIZE]
+            self.wfile.write(b"%x\r\n" % len(chunk))
+            self.wfile.write(chunk)
+            self.wfile.write(b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_error_json(self, status, message):
+        body = json.dumps({"error": message}, ensure_ascii=False).encode("utf-8")
+        self.send_body(status, body, "application/json; charset=utf-8")
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, quiet=False):
+    """创建 HTTP 服务（port 为 0 时由系统分配端口，见 server.server_address）"""
+    server = ThreadingHTTPServer((host, port), WatermarkHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.quiet = quiet
+    return server
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, quiet=False):
+    """前台运行，收到 SIGTERM 或 Ctrl+C 时退出"""
+    server = make_server(service, host, port, quiet)
+    service.start()
+    previous = signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        server.server_close()
+        service.close()
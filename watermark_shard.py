@@ -0,0 +1,376 @@
+"""多台机器分片导出：各节点指向共享存储上的同一批输入，不需要中心服务各自处理一部分
+
+两种分工方式：
+
+- 哈希分片（--shard K/N）：按文件相对路径的哈希取模，第 K 个节点只处理属于自己的那一份。不需要任何协调，
+  但某个节点中途宕机时，它的那一份要用同样的参数重新运行。
+- 租约（--lease）：节点处理一张图片前在共享的状态目录中创建租约文件（O_EXCL，同时只有一个节点能创建成功），
+  处理期间定期续约；租约超过 --lease-ttl 秒没有续约（节点崩溃）时由其他节点接手。
+
+每张图片处理完后在状态目录中留下完成标记，重新运行时跳过。每个节点把自己的结果报告写到状态目录的
+reports/ 下，全部节点结束后用 shard-merge 汇总，并写入输出文件夹的导出清单（之后的 export 可以增量运行）。
+
+文件按相对所在输入文件夹的路径区分，各节点的挂载路径不同也没关系。导出清单按本机路径记录，
+shard-merge 写入清单时把结果换成执行汇总的机器上的输入路径（--inputs）。
+"""
+import hashlib
+import json
+import os
+import re
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+from watermark_export import export_one, summarize
+from watermark_manifest import ExportManifest, settings_hash
+
+STATE_DIR_NAME = ".watermark_shards"
+_EXHAUSTED = object()
+DEFAULT_LEASE_TTL = 60
+# 其他节点持有租约时，多久再尝试一次（秒）
+RETRY_INTERVAL = 1.0
+
+
+def relative_name(path, roots=()):
+    """文件相对所在输入文件夹的路径（用 / 分隔，各节点挂载路径不同时也一致）；不在任何输入文件夹中时取文件名"""
+    real = os.path.abspath(path)
+    for root in roots:
+        root = os.path.abspath(root)
+        if real.startswith(root + os.sep):
+            return os.path.relpath(real, root).replace(os.sep, "/")
+    return os.path.basename(path)
+
+
+def file_key(name):
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+
+def shard_of(name, count):
+    return int(file_key(name)[:12], 16) % count
+
+
+def parse_shard(value):
+    """"K/N"（第 K 份，共 N 份，K 从 0 开始）-> (K, N)"""
+    index, sep, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = -1
+    if not sep or count <= 0 or not 0 <= index < count:
+        raise ValueError(f"分片应写成 K/N 且 0 <= K < N: {value}")
+    return index, count
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def default_state_dir(output_dir):
+    return os.path.join(output_dir, STATE_DIR_NAME)
+
+
+def _write_json(path, data):
+    """先写临时文件再原子替换，其他节点不会读到写了一半的内容"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class ShardState:
+    """状态目录：租约文件、完成标记和各节点的报告"""
+
+    def __init__(self, state_dir, node_id, lease_ttl=DEFAULT_LEASE_TTL):
+        self.dir = state_dir
+        self.node_id = node_id
+        self.lease_ttl = lease_ttl
+        self.reports_dir = os.path.join(state_dir, "reports")
+        os.makedirs(os.path.join(state_dir, "leases"), exist_ok=True)
+        os.makedirs(os.path.join(state_dir, "done"), exist_ok=True)
+        os.makedirs(self.reports_dir, exist_ok=True)
+        self.taken_over = 0
+
+    def lease_path(self, key):
+        return os.path.join(self.dir, "leases", f"{key}.lease")
+
+    def done_path(self, key):
+        return os.path.join(self.dir, "done", f"{key}.json")
+
+    def is_done(self, key, settings_key, output_dir):
+        """已经用同样的参数处理过，且输出文件还在"""
+        try:
+            with open(self.done_path(key), encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (record.get("settings") == settings_key
+                and os.path.exists(os.path.join(output_dir, os.path.basename(record.get("output") or ""))))
+
+    def mark_done(self, key, result, settings_key):
+        """完成标记中保存完整的结果记录：节点崩溃没来得及写报告时，汇总仍以完成标记为准"""
+        _write_json(self.done_path(key), {**result, "node": self.node_id, "settings": settings_key})
+
+    def load_done(self):
+        return list(_load_json_files(os.path.join(self.dir, "done")))
+
+    def claim(self, key):
+        """尝试取得租约；别的节点持有未过期的租约时返回 False"""
+        path = self.lease_path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                if age < self.lease_ttl:
+                    return False
+                # 租约过期：先把它改名，改名成功的节点才能接手（同时只有一个节点能成功）
+                stale_path = f"{path}.{self.node_id}.stale"
+                try:
+                    os.rename(path, stale_path)
+                except FileNotFoundError:
+                    continue
+                if time.time() - os.stat(stale_path).st_mtime < self.lease_ttl:
+                    # 查看和改名之间别的节点已经接手并创建了新租约：还回去（目标已存在时 link 会失败）
+                    try:
+                        os.link(stale_path, path)
+                    except OSError:
+                        pass
+                    os.remove(stale_path)
+                    return False
+                os.remove(stale_path)
+                self.taken_over += 1
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"node": self.node_id, "claimed": time.time()}, f)
+            return True
+        return False
+
+    def renew(self, keys):
+        for key in keys:
+            try:
+                os.utime(self.lease_path(key))
+            except FileNotFoundError:
+                pass
+
+    def release(self, key):
+        try:
+            os.remove(self.lease_path(key))
+        except FileNotFoundError:
+            pass
+
+    def write_report(self, report):
+        """每次运行一份报告（同一节点重新运行不会覆盖之前的报告）"""
+        name = re.sub(r"[^\w.-]+", "_", self.node_id)
+        _write_json(os.path.join(self.reports_dir, f"{name}.{int(report['started'] * 1000)}.json"), report)
+
+    def load_reports(self):
+        return list(_load_json_files(self.reports_dir))
+
+
+def _load_json_files(folder):
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(folder, name), encoding="utf-8") as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+class ShardedExport:
+    """一个节点上的分片导出：shard=(K, N) 为哈希分片，否则使用租约
+
+    图片的处理与 export 相同（export_one），由本节点的进程池并行处理。
+    """
+
+    def __init__(self, output_dir, settings, shard=None, lease_ttl=DEFAULT_LEASE_TTL, node_id=None,
+                 state_dir=None, workers=None, memory_budget=None):
+        self.output_dir = output_dir
+        self.settings = settings
+        self.settings_key = settings_hash(settings)
+        self.shard = shard
+        self.node_id = node_id or default_node_id()
+        self.state = ShardState(state_dir or default_state_dir(output_dir), self.node_id, lease_ttl)
+        self.workers = workers or os.cpu_count() or 1
+        self.memory_budget = memory_budget
+
+    @property
+    def mode(self):
+        return "hash" if self.shard else "lease"
+
+    def candidates(self, names):
+        """本节点要尝试的文件（{路径: 相对路径} 中的条目）：哈希分片时只取自己的那一份；
+        租约模式下各节点从不同位置开始，减少争抢"""
+        items = list(names.items())
+        if self.shard:
+            index, count = self.shard
+            return [(path, name) for path, name in items if shard_of(name, count) == index]
+        if not items:
+            return []
+        start = int(hashlib.sha1(self.node_id.encode("utf-8")).hexdigest()[:8], 16) % len(items)
+        return items[start:] + items[:start]
+
+    def claims(self, names):
+        """依次产生本节点取得的 (路径, 相对路径, key)；已完成的跳过
+
+        租约模式下，其他节点正在处理的图片先跳过，最后反复重试，直到它们处理完成或租约过期
+        （节点崩溃）后由本节点接手；需要等待时产生 None。
+        """
+        waiting = []
+        for path, name in self.candidates(names):
+            key = file_key(name)
+            if self.state.is_done(key, self.settings_key, self.output_dir):
+                continue
+            if self.shard:
+                yield path, name, key
+            elif self.try_claim(key):
+                yield path, name, key
+            else:
+                waiting.append((path, name, key))
+        while waiting:
+            still_waiting = []
+            for path, name, key in waiting:
+                if self.state.is_done(key, self.settings_key, self.output_dir):
+                    continue
+                if self.try_claim(key):
+                    yield path, name, key
+                else:
+                    still_waiting.append((path, name, key))
+            waiting = still_waiting
+            if waiting:
+                yield None
+
+    def try_claim(self, key):
+        if not self.state.claim(key):
+            return False
+        # 检查完成标记和取得租约之间，别的节点可能刚好处理完并释放了租约
+        if self.state.is_done(key, self.settings_key, self.output_dir):
+            self.state.release(key)
+            return False
+        return True
+
+    def run(self, paths, roots=(), progress=None):
+        """处理本节点分到的图片，返回结果记录（按完成顺序），并把报告写到状态目录
+
+        roots 是输入文件夹：图片按相对其所在输入文件夹的路径区分（结果记录中的 name）。
+        """
+        started = time.time()
+        task = partial(export_one, output_dir=self.output_dir, settings=self.settings,
+                       memory_budget=self.memory_budget, track_source=True)
+        renew_interval = self.state.lease_ttl / 3
+        claims = self.claims({path: relative_name(path, roots) for path in paths})
+        exhausted = False
+        in_flight = {}
+        report = []
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            while True:
+                # 只提前领取少量图片：领了没处理的租约会挡住其他节点
+                while len(in_flight) < self.workers * 2:
+                    item = next(claims, _EXHAUSTED)
+                    if item is _EXHAUSTED:
+                        exhausted = True
+                    if item is _EXHAUSTED or item is None:
+                        break
+                    in_flight[executor.submit(task, item[0])] = item
+                if not in_flight:
+                    if exhausted:
+                        break
+                    time.sleep(min(RETRY_INTERVAL, renew_interval))
+                    continue
+                done, _ = wait(in_flight, timeout=renew_interval, return_when=FIRST_COMPLETED)
+                if not self.shard:
+                    self.state.renew(key for _, _, key in in_flight.values())
+                for future in done:
+                    _, name, key = in_flight.pop(future)
+                    result = future.result()
+                    result["name"] = name
+                    if result["ok"]:
+                        self.state.mark_done(key, result, self.settings_key)
+                    if not self.shard:
+                        self.state.release(key)
+                    report.append(result)
+                    if progress:
+                        progress(result, len(report))
+        finally:
+            executor.shutdown(cancel_futures=True)
+            if not self.shard:
+                # 中断时放弃还没处理完的租约，其他节点不必等到过期
+                for _, _, key in in_flight.values():
+                    self.state.release(key)
+            self.state.write_report({
+                "node": self.node_id,
+                "mode": self.mode,
+                "shard": list(self.shard) if self.shard else None,
+                "settings": self.settings_key,
+                "started": started,
+                "finished": time.time(),
+                "taken_over": self.state.taken_over,
+                "summary": summarize(report, time.time() - started),
+                "files": report,
+            })
+        return report
+
+
+def merge_reports(output_dir, state_dir=None, paths=None, roots=()):
+    """汇总各节点的结果（按相对输入文件夹的路径合并）
+
+    成功的结果以完成标记为准（崩溃的节点没有报告，但它处理完的图片有完成标记），失败的取自各节点的报告。
+    指定 paths（本机上的全部输入，roots 是输入文件夹）时同时列出还没有处理成功的文件，
+    并在结果中记下本机路径 local_source（写入导出清单时使用）。
+    """
+    state = ShardState(state_dir or default_state_dir(output_dir), node_id="merge")
+    reports = sorted(state.load_reports(), key=lambda report: report["finished"])
+    files = {}
+    processed = {}
+    node_files = {}
+    node_seconds = {}
+    for report in reports:
+        node = report["node"]
+        node_files.setdefault(node, []).extend(report["files"])
+        node_seconds[node] = node_seconds.get(node, 0.0) + report["finished"] - report["started"]
+        for result in report["files"]:
+            name = result["name"]
+            if result["ok"]:
+                processed[name] = processed.get(name, 0) + 1
+            else:
+                files.setdefault(name, {**result, "node": node, "settings": report["settings"]})
+    for record in state.load_done():
+        files[record["name"]] = record
+    if paths is not None:
+        for path in paths:
+            result = files.get(relative_name(path, roots))
+            if result is not None:
+                result["local_source"] = path
+    merged = list(files.values())
+    elapsed = max(r["finished"] for r in reports) - min(r["started"] for r in reports) if reports else 0.0
+    summary = summarize(merged, elapsed)
+    summary["nodes"] = {node: summarize(node_files[node], node_seconds[node]) for node in node_files}
+    # 租约过期被接手、但原节点其实还在处理的图片会被处理两次（结果相同，只是浪费）
+    summary["duplicates"] = sum(1 for count in processed.values() if count > 1)
+    merged_report = {"summary": summary, "files": merged}
+    if paths is not None:
+        merged_report["missing"] = [path for path in paths
+                                    if not files.get(relative_name(path, roots), {}).get("ok")]
+    return merged_report
+
+
+def record_in_manifest(merged, output_dir):
+    """把汇总中成功的结果写入输出文件夹的导出清单，返回写入的条数
+
+    清单按路径记录源文件：汇总时指定了本机的输入（merge_reports 的 paths）就按本机路径记录，
+    之后在本机运行 export 可以识别；否则沿用处理该图片的节点上的路径。
+    """
+    manifest = ExportManifest(output_dir).load()
+    count = 0
+    for result in merged["files"]:
+        if result["ok"] and result.get("digest"):
+            manifest.record({**result, "source": result.get("local_source", result["source"])}, result["settings"])
+            count += 1
+    manifest.save()
+    return count
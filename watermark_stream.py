@@ -0,0 +1,273 @@
+"""流式水印：按条带/瓦片读写超大图片（全景图、扫描档案 TIFF），峰值内存由预算决定而与图片尺寸无关
+
+- 未压缩的 TIFF / BMP：先原样复制文件，再只读出与水印相交的行，混合后写回原位置
+- 压缩的 TIFF（需要安装 tifffile）：逐个条带/瓦片解码，只混合与水印相交的部分，再按瓦片写出
+
+其他格式（JPEG、PNG 等）无法按条带处理，超出预算时给出警告，仍按常规路径完整解码。
+"""
+import math
+import shutil
+import warnings
+
+from PIL import Image
+
+from watermark_engine import has_watermark, logo_for, output_path_for, overlay_for, stamp_for, tile_for
+from watermark_metrics import metrics
+
+try:
+    import numpy as np
+    import tifffile
+except ImportError:  # 可选依赖，只在处理压缩 TIFF 时需要
+    tifffile = None
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# 常规路径解码后同时存在的整图副本数（原图 + 转换后的图）
+FULL_DECODE_COPIES = 2
+
+STREAMABLE_MODES = ('RGB', 'RGBA', 'L')
+
+
+class StreamingUnsupported(Exception):
+    """图片的存储方式无法按条带处理"""
+
+
+def open_header(path):
+    """只读取文件头（超大图片会触发 Pillow 的解压炸弹检查，这里临时关闭）"""
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def decoded_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def tiff_segment_bytes(image_path):
+    """压缩 TIFF 中最大的一个条带/瓦片解码后的字节数（流式处理时每次要整块解码一个）"""
+    with tifffile.TiffFile(image_path) as tif:
+        page = tif.pages[0]
+        if page.is_tiled:
+            rows, columns = page.tilelength, page.tilewidth
+        else:
+            rows, columns = min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+        return rows * columns * page.samplesperpixel * page.dtype.itemsize
+
+
+def streaming_unsupported_reason(image_path, image, memory_budget):
+    """图片不能在 memory_budget 内按条带处理的原因；能处理时返回 None"""
+    if raw_layout(image) is not None:
+        return None
+    if image.format != "TIFF":
+        return f"{image.format} 格式不支持流式处理"
+    if tifffile is None:
+        return "压缩的 TIFF 需要安装 tifffile 才能流式处理"
+    # 只有一个条带（或条带很大）的压缩 TIFF，解码一个条带就相当于解码整张图片
+    if tiff_segment_bytes(image_path) * FULL_DECODE_COPIES > memory_budget:
+        return "单个条带/瓦片解码后就超出内存预算"
+    return None
+
+
+def should_stream(image_path, memory_budget):
+    """按文件头判断：解码后超出内存预算且能按条带处理时返回 True
+
+    超出预算但无法流式处理时给出警告并返回 False，由调用方完整解码（峰值内存会超出预算）。
+    """
+    with open_header(image_path) as image:
+        if decoded_bytes(image) * FULL_DECODE_COPIES <= memory_budget:
+            return False
+        reason = streaming_unsupported_reason(image_path, image, memory_budget)
+    if reason is None:
+        return True
+    warnings.warn(f"{image_path} 解码后超出内存预算，但{reason}，改为完整解码", RuntimeWarning, stacklevel=2)
+    return False
+
+
+def watermark_file_streaming(image_path, output_dir, settings, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """按条带/瓦片为图片添加水印，输出格式与原图相同；返回输出路径"""
+    output_path = output_path_for(image_path, output_dir)
+    with open_header(image_path) as image:
+        layout = raw_layout(image)
+        image_format = image.format
+        image_size, image_mode = image.size, image.mode
+    if layout is not None:
+        patch_raw_file(image_path, output_path, image_size, image_mode, layout, settings, memory_budget)
+    elif image_format == "TIFF" and tifffile is not None:
+        rewrite_tiff(image_path, output_path, settings, memory_budget)
+    elif image_format == "TIFF":
+        raise StreamingUnsupported("压缩的 TIFF 需要安装 tifffile 才能流式处理")
+    else:
+        raise StreamingUnsupported(f"{image_format} 格式不支持流式处理")
+    return output_path
+
+
+def raw_layout(image):
+    """未压缩图片的存储布局 [(范围, 偏移, rawmode, 行字节数, 行方向)]，不能原位修改时返回 None"""
+    if image.mode not in STREAMABLE_MODES or not image.tile:
+        return None
+    layout = []
+    seen = set()
+    for codec, extents, offset, args in image.tile:
+        if codec != "raw" or extents in seen:
+            # 压缩数据，或按颜色分平面存储（同一范围出现多次）
+            return None
+        seen.add(extents)
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+        try:
+            pixel_bytes = len(Image.new(image.mode, (1, 1)).tobytes("raw", rawmode))
+        except Exception:
+            return None
+        left, _, right, _ = extents
+        layout.append((extents, offset, rawmode, stride or (right - left) * pixel_bytes, orientation or 1))
+    return layout
+
+
+def blend_region(region, blend, offset):
+    """在条带/瓦片上混合水印，offset 是区域左上角在整张图片中的坐标（灰度图借道 RGB 混合）"""
+    if region.mode == "L":
+        return blend(region.convert("RGB"), offset).convert("L")
+    return blend(region, offset)
+
+
+def overlay_bytes(image_size, settings):
+    """水印图章（或平铺单元）和图片水印占用的内存"""
+    images = []
+    if settings.text:
+        images.append(tile_for(settings)[0] if settings.layout == "tiled" else stamp_for(settings)[0])
+    if settings.logo_path:
+        images.append(logo_for(image_size, settings)[0])
+    return sum(image.width * image.height * 4 for image in images)
+
+
+def patch_raw_file(image_path, output_path, image_size, mode, layout, settings, memory_budget):
+    shutil.copyfile(image_path, output_path)
+    if not has_watermark(settings):
+        return
+    (left, top, width, height), blend = overlay_for(image_size, settings)
+    stamp_bytes = overlay_bytes(image_size, settings)
+
+    with open(output_path, "r+b") as f:
+        for (x0, y0, x1, y1), offset, rawmode, stride, orientation in layout:
+            # 只处理与水印相交的行
+            first, last = max(top, y0), min(top + height, y1)
+            if first >= last or left >= x1 or left + width <= x0:
+                continue
+            rows_per_band = max(1, (memory_budget - stamp_bytes) // (stride * FULL_DECODE_COPIES))
+            for band_top in range(first, last, rows_per_band):
+                band_bottom = min(last, band_top + rows_per_band)
+                rows = band_bottom - band_top
+                # 自下而上存储（BMP）时文件中的行序是反的
+                if orientation > 0:
+                    file_row = band_top - y0
+                else:
+                    file_row = (y1 - y0) - (band_bottom - y0)
+                f.seek(offset + file_row * stride)
+                data = f.read(rows * stride)
+                band = Image.frombytes(mode, (x1 - x0, rows), data, "raw", rawmode, stride, orientation)
+                band = blend_region(band, blend, (x0, band_top))
+                f.seek(offset + file_row * stride)
+                f.write(band.tobytes("raw", (rawmode, stride, orientation)))
+
+
+def _blend_array(tile, blend, offset):
+    """在 numpy 瓦片 (行, 列, 通道) 上混合水印"""
+    samples = tile.shape[2]
+    region = Image.fromarray(tile[:, :, 0] if samples == 1 else tile)
+    blended = np.asarray(blend_region(region, blend, offset))
+    return blended.reshape(tile.shape)
+
+
+def rewrite_tiff(image_path, output_path, settings, memory_budget):
+    with tifffile.TiffFile(image_path) as tif:
+        page = tif.pages[0]
+        samples = page.samplesperpixel
+        if page.dtype != np.uint8 or samples not in (1, 3, 4) or (samples > 1 and page.planarconfig != 1):
+            raise StreamingUnsupported("只支持 8 位、交错存储的灰度/RGB/RGBA TIFF")
+        height, width = page.imagelength, page.imagewidth
+
+        blend = None
+        if has_watermark(settings):
+            box, blend = overlay_for((width, height), settings)
+        else:
+            box = (0, 0, 0, 0)
+
+        if page.is_tiled:
+            tile_shape = (page.tilelength, page.tilewidth)
+            tiles = _tiled_segments(page, samples, blend, box)
+        else:
+            # 条带转成瓦片写出：同时只缓存一行瓦片
+            row_bytes = math.ceil(width / 256) * 256 * samples
+            tile_height = max(16, min(256, (memory_budget // (row_bytes * 2)) // 16 * 16))
+            tile_shape = (tile_height, 256)
+            tiles = _strip_segments(page, samples, blend, box, tile_shape)
+
+        shape = (height, width, samples) if samples > 1 else (height, width)
+        options = {
+            "compression": output_compression(page.compression),
+            "photometric": page.photometric,
+            "planarconfig": "contig",
+        }
+        if page.predictor > 1:
+            options["predictor"] = page.predictor
+        if page.extrasamples:
+            options["extrasamples"] = page.extrasamples
+        with tifffile.TiffWriter(output_path, bigtiff=height * width * samples >= 2 ** 32 - 2 ** 25) as writer:
+            writer.write(tiles, shape=shape, dtype=np.uint8, tile=tile_shape, **options)
+
+
+def output_compression(compression):
+    """沿用原图的压缩方式；tifffile 没有对应编码器（如 LZW 需要 imagecodecs）时改用 Deflate"""
+    try:
+        tifffile.TIFF.COMPRESSORS[compression]
+        return compression
+    except KeyError:
+        return tifffile.COMPRESSION.ADOBE_DEFLATE
+
+
+def _overlaps(box, x, y, w, h):
+    left, top, width, height = box
+    return left < x + w and x < left + width and top < y + h and y < top + height
+
+
+def _tiled_segments(page, samples, blend, box):
+    for data, indices, _ in page.segments(maxworkers=1):
+        tile = data[0]
+        y, x = indices[-3], indices[-2]
+        if blend is not None and _overlaps(box, x, y, tile.shape[1], tile.shape[0]):
+            tile = _blend_array(tile, blend, (x, y))
+        yield tile
+
+
+def _strip_segments(page, samples, blend, box, tile_shape):
+    tile_height, tile_width = tile_shape
+    width = page.imagewidth
+    padded_width = math.ceil(width / tile_width) * tile_width
+    band = np.zeros((tile_height, padded_width, samples), dtype=np.uint8)
+    band_top, filled = 0, 0
+
+    def flush():
+        if blend is not None and _overlaps(box, 0, band_top, width, tile_height):
+            band[:, :width] = _blend_array(np.ascontiguousarray(band[:, :width]), blend, (0, band_top))
+        for x in range(0, padded_width, tile_width):
+            yield band[:, x:x + tile_width].copy()
+
+    for data, _, _ in page.segments(maxworkers=1):
+        strip = data[0]
+        offset = 0
+        while offset < strip.shape[0]:
+            rows = min(tile_height - filled, strip.shape[0] - offset)
+            band[filled:filled + rows, :width] = strip[offset:offset + rows]
+            filled += rows
+            offset += rows
+            if filled == tile_height:
+                yield from flush()
+                band_top += tile_height
+                band[:] = 0
+                filled = 0
+    if filled:
+        yield from flush()
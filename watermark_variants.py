@@ -0,0 +1,241 @@
+"""一次解码，导出多个版本（尺寸 / 格式 / 质量 / 水印参数各不相同）
+
+任务描述文件（JSON）:
+
+    {
+      "settings": {"text": "© 2024"},
+      "variants": [
+        {"name": "archive", "format": "jpeg", "quality": 95},
+        {"name": "web", "max_size": 2048, "quality": 85},
+        {"name": "thumb", "max_size": 512, "format": "webp", "quality": 80, "settings": {"opacity": 50}}
+      ]
+    }
+
+每个源文件只解码一次：所有版本都缩小时 JPEG 直接按最大版本所需的分辨率解码（DCT 缩放）；
+各版本从大到小依次由上一个（更大的）中间结果缩小得到，然后各自加水印、在线程中并行编码
+（Pillow 编码时释放 GIL）。输出保存在 <输出文件夹>/<版本名>/ 下。
+
+版本的 settings 中没有指定 font_size 时，字号和平铺间距随图片按比例缩小（与预览相同，看起来和原图一致）。
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from functools import partial
+
+from PIL import Image
+
+from watermark_batch import add_watermark_batched
+from watermark_engine import WatermarkSettings, check_setting, normalize_mode
+from watermark_export import count_result, error_message, map_export, new_result
+from watermark_metrics import metrics
+
+# 格式 -> (扩展名, Pillow 格式名)
+FORMATS = {"jpeg": (".jpg", "JPEG"), "png": (".png", "PNG"), "webp": (".webp", "WEBP"), "tiff": (".tif", "TIFF")}
+VARIANT_KEYS = ("name", "max_size", "format", "quality", "settings")
+SETTINGS_KEYS = tuple(field.name for field in fields(WatermarkSettings))
+
+
+@dataclass(frozen=True)
+class OutputVariant:
+    """一个输出版本（纯数据，可跨进程传递）"""
+    name: str
+    settings: WatermarkSettings
+    max_size: int = None  # 长边像素上限；None 表示原尺寸
+    format: str = "jpeg"
+    quality: int = 90
+    scale_watermark: bool = True  # 字号和平铺间距是否随图片按比例缩小
+
+    def settings_for(self, size, full_size):
+        """缩小后的图片使用的水印参数"""
+        scale = max(size) / max(full_size)
+        if not self.scale_watermark or scale == 1:
+            return self.settings
+        return self.settings.with_changes(font_size=max(1, round(self.settings.font_size * scale)),
+                                          tile_spacing=max(1, round(self.settings.tile_spacing * scale)))
+
+    def target_size(self, size):
+        """按长边上限等比缩小后的尺寸（不放大）"""
+        width, height = size
+        if not self.max_size or max(width, height) <= self.max_size:
+            return width, height
+        scale = self.max_size / max(width, height)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def output_path(self, image_path, output_dir):
+        """输出路径 <输出文件夹>/<版本名>/watermarked_<原文件名>
+
+        原扩展名与版本格式不同时保留原扩展名，再加上版本的扩展名（x.png 导出 JPEG 为 watermarked_x.png.jpg），
+        同名不同格式的源文件不会互相覆盖。
+        """
+        name = os.path.basename(image_path)
+        ext = FORMATS[self.format][0]
+        if os.path.splitext(name)[1].lower() != ext:
+            name += ext
+        return os.path.join(output_dir, self.name, f"watermarked_{name}")
+
+
+def _check_keys(data, allowed, where):
+    if not isinstance(data, dict):
+        raise ValueError(f"{where}应为 JSON 对象")
+    unknown = sorted(set(data) - set(allowed))
+    if unknown:
+        raise ValueError(f"{where}中有不支持的字段: {', '.join(unknown)}")
+
+
+def _check_settings(data, where):
+    """检查 settings 中的字段和取值（与 HTTP 服务的请求参数相同的校验），返回转换后的参数"""
+    _check_keys(data, SETTINGS_KEYS, where)
+    try:
+        return {name: check_setting(name, value) for name, value in data.items()}
+    except ValueError as e:
+        raise ValueError(f"{where}{e}") from None
+
+
+def parse_job(data, settings):
+    """把任务描述（dict）解析成 OutputVariant 列表；settings 是命令行给出的基础水印参数"""
+    _check_keys(data, ("settings", "variants"), "任务描述")
+    settings = settings.with_changes(**_check_settings(data.get("settings", {}), "settings "))
+    variants = []
+    for item in data.get("variants") or []:
+        _check_keys(item, VARIANT_KEYS, "variants ")
+        name = item.get("name")
+        if not name or os.sep in name or name in (".", ".."):
+            raise ValueError(f"版本名无效: {name!r}")
+        fmt = item.get("format", "jpeg").lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in FORMATS:
+            raise ValueError(f"版本 {name} 的格式应为 {', '.join(FORMATS)} 之一")
+        max_size = item.get("max_size")
+        if max_size is not None and (not isinstance(max_size, int) or max_size <= 0):
+            raise ValueError(f"版本 {name} 的 max_size 应为正整数")
+        quality = item.get("quality", 90)
+        if not isinstance(quality, int) or not 1 <= quality <= 100:
+            raise ValueError(f"版本 {name} 的 quality 应为 1-100 的整数")
+        overrides = _check_settings(item.get("settings", {}), f"版本 {name} 的 settings ")
+        variants.append(OutputVariant(name=name, settings=settings.with_changes(**overrides), max_size=max_size,
+                                      format=fmt, quality=quality,
+                                      scale_watermark="font_size" not in overrides))
+    if not variants:
+        raise ValueError("任务描述中没有 variants")
+    names = [variant.name for variant in variants]
+    if len(set(names)) != len(names):
+        raise ValueError("版本名重复")
+    return variants
+
+
+def load_job(path, settings):
+    with open(path, encoding="utf-8") as f:
+        return parse_job(json.load(f), settings)
+
+
+def save_variant(image, output_path, variant):
+    """按版本的格式和质量编码保存"""
+    fmt = FORMATS[variant.format][1]
+    if fmt == "JPEG":
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(output_path, fmt, quality=variant.quality)
+    elif fmt == "WEBP":
+        image.save(output_path, fmt, quality=variant.quality)
+    elif fmt == "PNG":
+        image.save(output_path, fmt, compress_level=6)
+    else:
+        image.save(output_path, fmt, compression="tiff_deflate")
+
+
+def decode_for(image_path, variants):
+    """解码源文件，返回 (图片, 原始尺寸)
+
+    所有版本都比原图小时，JPEG 只解码到不小于最大版本的分辨率（1/2、1/4、1/8 的 DCT 缩放）。
+    """
+    with Image.open(image_path) as original:
+        full_size = original.size
+        largest = max(variant.target_size(full_size) for variant in variants)
+        if largest != full_size and original.format == "JPEG":
+            original.draft("RGB", largest)
+        with metrics.stage("decode"):
+            original.load()
+        return normalize_mode(original), full_size
+
+
+def scale_variants(image, full_size, variants):
+    """从大到小依次缩小，返回 {版本名: 未加水印的图片}；尺寸相同的版本共用同一张图片"""
+    scaled = {}
+    base = image
+    for variant in sorted(variants, key=lambda variant: variant.target_size(full_size), reverse=True):
+        size = variant.target_size(full_size)
+        if base.size != size:
+            # 由上一个（更大的）中间结果缩小，而不是每次都从原图缩小
+            with metrics.stage("resize"):
+                base = base.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        scaled[variant.name] = base
+    return scaled
+
+
+def finish_variant(image, variant, image_path, output_dir, full_size):
+    """加水印并编码保存一个版本，返回输出路径（在线程中运行）"""
+    image = add_watermark_batched(image, variant.settings_for(image.size, full_size), inplace=True)
+    output_path = variant.output_path(image_path, output_dir)
+    with metrics.stage("encode"):
+        save_variant(image, output_path, variant)
+    if metrics.enabled:
+        metrics.count("bytes_written", os.path.getsize(output_path))
+    return output_path
+
+
+def export_variants(image_path, output_dir, variants, encode_threads=None):
+    """处理单张图片的全部版本，返回结果记录（不抛出异常）；outputs 是 {版本名: 输出路径}"""
+    start = time.perf_counter()
+    result = new_result(image_path)
+    try:
+        with metrics.image(image_path):
+            image, full_size = decode_for(image_path, variants)
+            scaled = scale_variants(image, full_size, variants)
+            del image
+            # 加水印会原地修改图片，共用同一张图片的版本除第一个外都先复制
+            jobs = []
+            claimed = set()
+            for variant in variants:
+                image = scaled[variant.name]
+                if id(image) in claimed:
+                    image = image.copy()
+                claimed.add(id(image))
+                jobs.append((image, variant))
+            del scaled, image
+            with ThreadPoolExecutor(max_workers=encode_threads or len(jobs)) as executor:
+                futures = [executor.submit(finish_variant, image, variant, image_path, output_dir, full_size)
+                           for image, variant in jobs]
+                del jobs
+                outputs = {variant.name: future.result() for variant, future in zip(variants, futures)}
+            result.update(output=outputs[variants[0].name], outputs=outputs, ok=True)
+    except Exception as e:
+        result["error"] = error_message(image_path, e)
+    finally:
+        result["seconds"] = round(time.perf_counter() - start, 4)
+        if metrics.enabled:
+            count_result(image_path, result)
+    return result
+
+
+def duplicate_variant_outputs(paths, variants):
+    """输出路径相同、会互相覆盖的源文件 {输出路径（相对输出文件夹）: [源文件, ...]}（如不同文件夹中的同名图片）"""
+    sources = {}
+    for variant in variants:
+        for path in paths:
+            sources.setdefault(variant.output_path(path, ""), []).append(path)
+    return {name: group for name, group in sources.items() if len(group) > 1}
+
+
+def run_variants(paths, output_dir, variants, workers=None, chunksize=None, encode_threads=None, progress=None):
+    """并行处理多张图片的全部版本，按输入顺序返回结果记录；输出路径有冲突时抛出 ValueError"""
+    duplicates = duplicate_variant_outputs(paths, variants)
+    if duplicates:
+        name, sources = next(iter(duplicates.items()))
+        raise ValueError(f"{len(duplicates)} 个输出文件对应多张图片，如 {name}: {', '.join(sources)}")
+    for variant in variants:
+        os.makedirs(os.path.join(output_dir, variant.name), exist_ok=True)
+    task = partial(export_variants, output_dir=output_dir, variants=variants, encode_threads=encode_threads)
+    return map_export(task, paths, workers=workers, chunksize=chunksize, progress=progress)
@@ -0,0 +1,169 @@
+"""视口渲染：多分辨率瓦片金字塔，缩放/平移时只重采样可见区域的瓦片"""
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from watermark_engine import (blend_stamp, blend_tiled, has_watermark, logo_for, stamp_box, stamp_for, tile_anchor,
+                              tile_for)
+from watermark_preview import image_bytes
+
+TILE_SIZE = 256
+DEFAULT_TILE_CACHE_BYTES = 64 * 1024 * 1024
+# 预览内存上限中分给瓦片缓存的比例，其余给 ProxyCache
+TILE_CACHE_SHARE = 0.25
+PREVIEW_BACKGROUND = (211, 211, 211)  # lightgray，与预览容器背景一致
+
+
+def split_preview_budget(total_bytes):
+    """把预览的内存上限分成 (ProxyCache 的上限, 瓦片缓存的上限)，两者之和不超过 total_bytes"""
+    tile_bytes = int(total_bytes * TILE_CACHE_SHARE)
+    return total_bytes - tile_bytes, tile_bytes
+
+
+def level_factor_for(scale):
+    """满足 1/factor >= scale 的最大 2 的幂缩小倍数（保证所选层级分辨率不低于显示分辨率）"""
+    factor = 1
+    while scale * factor * 2 <= 1:
+        factor *= 2
+    return factor
+
+
+class TilePyramid:
+    """单张图片的瓦片金字塔
+
+    第 k 层是原图缩小 2^k 倍的图片（由 ProxyCache 提供并计入其内存上限，JPEG 可直接缩小解码）；
+    瓦片是按显示坐标划分的 TILE_SIZE 方块，从最接近的层级重采样得到，按 (缩放比例, 行, 列) 缓存，
+    总内存超过 max_bytes 时淘汰最久未用的瓦片。
+    """
+
+    def __init__(self, path, proxy_cache, tile_size=TILE_SIZE, max_bytes=DEFAULT_TILE_CACHE_BYTES):
+        self.path = path
+        self.proxy_cache = proxy_cache
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.mtime = os.stat(path).st_mtime_ns
+        self.original_size = proxy_cache.original_size(path)
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def display_size(self, scale):
+        return max(1, int(self.original_size[0] * scale)), max(1, int(self.original_size[1] * scale))
+
+    def tile(self, scale, column, row):
+        """显示坐标下第 (column, row) 块瓦片（边缘的瓦片可能小于 tile_size）"""
+        key = (round(scale, 6), column, row)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+
+        factor = level_factor_for(scale)
+        level = self.proxy_cache.get_reduced(self.path, factor)
+        display_width, display_height = self.display_size(scale)
+        left, top = column * self.tile_size, row * self.tile_size
+        right = min(left + self.tile_size, display_width)
+        bottom = min(top + self.tile_size, display_height)
+        # 显示坐标 -> 该层级坐标；带 box 的 resize 会使用框外的相邻像素做滤波，瓦片拼接处没有接缝
+        ratio_x = level.width / display_width
+        ratio_y = level.height / display_height
+        box = (left * ratio_x, top * ratio_y, right * ratio_x, bottom * ratio_y)
+        tile = level.resize((right - left, bottom - top), Image.Resampling.LANCZOS, box=box)
+
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile
+                self.current_bytes += image_bytes(tile)
+            # 至少保留最新的一块
+            while self.current_bytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self.current_bytes -= image_bytes(evicted)
+        return tile
+
+
+class ViewportRenderer:
+    """把可见区域的瓦片拼成画布大小的预览图，并叠加按显示比例缩放的水印"""
+
+    def __init__(self, proxy_cache, tile_size=TILE_SIZE, max_tile_bytes=DEFAULT_TILE_CACHE_BYTES):
+        self.proxy_cache = proxy_cache
+        self.tile_size = tile_size
+        self.max_tile_bytes = max_tile_bytes
+        self._pyramid = None
+
+    def pyramid(self, path):
+        """当前图片的金字塔（切换图片或文件被修改时重建）"""
+        pyramid = self._pyramid
+        if pyramid is None or pyramid.path != path or pyramid.mtime != os.stat(path).st_mtime_ns:
+            pyramid = TilePyramid(path, self.proxy_cache, self.tile_size, self.max_tile_bytes)
+            self._pyramid = pyramid
+        return pyramid
+
+    def image_origin(self, display_size, center, canvas_size):
+        """图片左上角在画布上的坐标：小于画布时居中，否则以 center（0-1 的相对坐标）为视口中心"""
+        origin = []
+        for length, c, view in zip(display_size, center, canvas_size):
+            if length <= view:
+                origin.append((view - length) // 2)
+            else:
+                origin.append(int(round(view / 2 - c * length)))
+        return tuple(origin)
+
+    def render(self, path, scale, center, canvas_size, settings=None):
+        """渲染画布大小的预览图，只生成与画布相交的瓦片"""
+        pyramid = self.pyramid(path)
+        display_width, display_height = pyramid.display_size(scale)
+        origin_x, origin_y = self.image_origin((display_width, display_height), center, canvas_size)
+        canvas_width, canvas_height = max(1, canvas_size[0]), max(1, canvas_size[1])
+        viewport = Image.new("RGB", (canvas_width, canvas_height), PREVIEW_BACKGROUND)
+
+        # 可见区域（显示坐标）
+        visible_left = max(0, -origin_x)
+        visible_top = max(0, -origin_y)
+        visible_right = min(display_width, canvas_width - origin_x)
+        visible_bottom = min(display_height, canvas_height - origin_y)
+        if visible_right <= visible_left or visible_bottom <= visible_top:
+            return viewport
+
+        size = self.tile_size
+        for row in range(visible_top // size, math.ceil(visible_bottom / size)):
+            for column in range(visible_left // size, math.ceil(visible_right / size)):
+                tile = pyramid.tile(scale, column, row)
+                position = (origin_x + column * size, origin_y + row * size)
+                if tile.mode == "RGBA":
+                    viewport.paste(tile, position, tile)
+                else:
+                    viewport.paste(tile, position)
+
+        if settings is not None and has_watermark(settings):
+            origin = (origin_x, origin_y)
+            if settings.logo_path:
+                self.overlay_logo(viewport, pyramid, scale, origin, settings)
+            if settings.text and settings.layout == "tiled":
+                visible = (origin_x + visible_left, origin_y + visible_top,
+                           origin_x + visible_right, origin_y + visible_bottom)
+                self.overlay_tiled(viewport, (display_width, display_height), scale, origin, visible, settings)
+            elif settings.text:
+                self.overlay_watermark(viewport, pyramid, scale, origin, settings)
+        return viewport
+
+    def overlay_logo(self, viewport, pyramid, scale, origin, settings):
+        # 图片水印按显示宽度从缩放阶梯中取，位置按原图计算后再缩放
+        logo, (x, y) = logo_for(pyramid.original_size, settings, scale)
+        blend_stamp(viewport, logo, (origin[0] + x, origin[1] + y))
+
+    def overlay_tiled(self, viewport, display_size, scale, origin, visible, settings):
+        # 按显示比例栅格化的平铺单元，只铺可见区域；图案以图片中心为基准，与导出结果一致
+        tile, stamp_size = tile_for(settings, max(1, round(settings.font_size * scale)))
+        anchor = tile_anchor(display_size, stamp_size)
+        blend_tiled(viewport, tile, (origin[0] + anchor[0], origin[1] + anchor[1]), visible)
+
+    def overlay_watermark(self, viewport, pyramid, scale, origin, settings):
+        # 位置按原图计算后再缩放，保证与导出结果一致；图章按显示字号栅格化
+        left, top, _, _ = stamp_box(pyramid.original_size, settings)
+        stamp, _ = stamp_for(settings, max(1, round(settings.font_size * scale)))
+        position = (origin[0] + int(round(left * scale)), origin[1] + int(round(top * scale)))
+        blend_stamp(viewport, stamp, position)
@@ -0,0 +1,417 @@
+"""监视文件夹（热文件夹）：持续为新放入的图片加水印并导出
+
+    python watermark_cli.py watch ./inbox -o ./out --text "© 2024"
+
+Linux 上通过 inotify（ctypes 调用 libc，不需要额外依赖）接收文件变化，其他平台或 inotify 不可用时定时扫描。
+文件的大小和 mtime 在一段时间内（默认 0.3 秒）不再变化才认为写完；写完的文件攒成小批次交给常驻的进程池。
+结果记录在输出文件夹的导出清单中（与 export 命令共用），重启后已处理过的文件不会重复处理。
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from watermark_engine import IMAGE_EXTENSIONS, iter_images, output_path_for
+from watermark_export import export_one, ignore_interrupts
+from watermark_manifest import ExportManifest, settings_hash, source_key
+
+DEFAULT_SETTLE = 0.3
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_BATCH_WINDOW = 0.05
+DEFAULT_MAX_BATCH = 32
+# 把日志合并进清单的间隔（秒）；日志每处理完一张就追加写入，中途退出也不会丢记录
+COMPACT_INTERVAL = 600
+# 工作进程异常退出（如被 OOM 杀掉）时，批次中的图片最多重试的次数
+MAX_RETRIES = 1
+
+# inotify 事件（见 <sys/inotify.h>）
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+def is_candidate(path):
+    """可能是要处理的图片（忽略隐藏文件，上传工具的临时文件通常以点开头）"""
+    name = os.path.basename(path)
+    return not name.startswith(".") and name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+class InotifyWatcher:
+    """Linux inotify；poll() 返回有变化的图片路径"""
+
+    def __init__(self, folders, recursive=False, exclude=None):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.recursive = recursive
+        self.exclude = exclude
+        self.folders = list(folders)
+        self.watches = {}
+        for folder in self.folders:
+            self.add(folder)
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith("linux") and hasattr(os, "O_CLOEXEC")
+
+    def add(self, folder):
+        """监视文件夹（递归时包括其中已有的子文件夹），返回其中已有的图片"""
+        if self.exclude and os.path.abspath(folder) == self.exclude:
+            return []
+        wd = self._add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"无法监视 {folder}: {os.strerror(error)}")
+        self.watches[wd] = folder
+        found = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if self.recursive and entry.is_dir(follow_symlinks=False):
+                        found += self.add_subfolder(entry.path)
+                    elif is_candidate(entry.path):
+                        found.append(entry.path)
+        except OSError:
+            pass
+        return found
+
+    def add_subfolder(self, folder):
+        """监视子文件夹；子文件夹已被删除或没有权限时跳过，不影响其他文件夹"""
+        try:
+            return self.add(folder)
+        except OSError as e:
+            print(f"跳过子文件夹 {folder}: {e}", file=sys.stderr)
+            return []
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，丢失的事件无法恢复，重新扫描全部文件夹
+                return [path for folder in self.folders for path in iter_images(folder, self.recursive)]
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    # 新建或移入的子文件夹：开始监视之前可能已经有文件写进去了
+                    changed += self.add_subfolder(path)
+            elif is_candidate(path):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """定时扫描文件夹（没有 inotify 时使用，也适用于 inotify 收不到远端修改的网络共享盘）"""
+
+    def __init__(self, folders, recursive=False, exclude=None, interval=DEFAULT_POLL_INTERVAL):
+        self.folders = list(folders)
+        self.recursive = recursive
+        self.exclude = exclude
+        self.interval = interval
+        self.signatures = {}
+        self.next_scan = 0.0
+
+    def scan(self):
+        signatures = {}
+        for folder in self.folders:
+            for path in iter_images(folder, self.recursive):
+                if self.exclude and os.path.abspath(path).startswith(self.exclude + os.sep):
+                    continue
+                if not is_candidate(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signatures[path] = (stat.st_size, stat.st_mtime_ns)
+        changed = [path for path, signature in signatures.items() if self.signatures.get(path) != signature]
+        self.signatures = signatures
+        return changed
+
+    def poll(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if time.monotonic() < self.next_scan:
+                return []
+        self.next_scan = time.monotonic() + self.interval
+        return self.scan()
+
+    def close(self):
+        pass
+
+
+def _export_batch(items, output_dir, settings):
+    """工作进程中处理一个小批次；同尺寸的图片复用合成计划"""
+    return [export_one(path, output_dir, settings, previous_digest=digest, track_source=True, batch=True)
+            for path, digest in items]
+
+
+class FolderWatcher:
+    """监视一个或多个文件夹，把写完的图片加水印后保存到 output_dir
+
+    run() 一直运行到 stop() 被调用（可以从其他线程或信号处理函数中调用）。
+    每处理完一张图片调用一次 on_result(result)，result 中的 latency 是从第一次发现文件到写出结果的秒数。
+    """
+
+    def __init__(self, folders, output_dir, settings, workers=None, recursive=False, settle=DEFAULT_SETTLE,
+                 poll_interval=DEFAULT_POLL_INTERVAL, batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH,
+                 polling=False, use_manifest=True, on_result=None):
+        self.folders = list(folders)
+        self.output_dir = output_dir
+        self.settings = settings
+        self.workers = workers or os.cpu_count() or 1
+        self.recursive = recursive
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.polling = polling
+        self.on_result = on_result
+        self.manifest = ExportManifest(output_dir).load() if use_manifest else None
+        self.settings_key = settings_hash(settings)
+        self.pending = {}  # 路径 -> [(大小, mtime), 最近一次变化的时间, 第一次发现的时间]
+        self.ready = []  # [(路径, 第一次发现的时间)]
+        self.ready_since = None
+        self.in_flight = {}  # future -> (进程池, [(路径, 第一次发现的时间)])
+        self.busy = set()
+        self.dirty = set()  # 处理过程中又有变化的文件，处理完后重新检查
+        self.retries = {}  # 路径 -> 因工作进程异常退出而重试的次数
+        # 输出文件名 -> 源文件：包含子文件夹时，不同文件夹中的同名图片会写到同一个输出文件
+        self.output_owners = {}
+        if self.manifest is not None:
+            for source, entry in self.manifest.entries.items():
+                self.output_owners[entry.get("output")] = source
+        self.executor = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def open_watcher(self):
+        exclude = os.path.abspath(self.output_dir)
+        if not self.polling and InotifyWatcher.available():
+            try:
+                return InotifyWatcher(self.folders, self.recursive, exclude)
+            except OSError as e:
+                print(f"inotify 不可用（{e}），改为定时扫描", file=sys.stderr)
+        return PollingWatcher(self.folders, self.recursive, exclude, self.poll_interval)
+
+    def start_pool(self):
+        # 工作进程不理会 Ctrl+C：在途的图片处理完后由 run() 关闭进程池
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=ignore_interrupts)
+
+    def restart_pool(self, broken):
+        """有工作进程异常退出后整个进程池都不能再用，换一个新的（同一个进程池只换一次）"""
+        if self.executor is broken and not self._stop.is_set():
+            print("工作进程异常退出，重新创建进程池", file=sys.stderr)
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.start_pool()
+
+    def run(self):
+        watcher = self.open_watcher()
+        self.start_pool()
+        last_compact = time.monotonic()
+        # 启动时文件夹里已有的文件也要检查一遍（清单中已处理过的会被跳过）
+        touched = [path for folder in self.folders for path in iter_images(folder, self.recursive)
+                   if is_candidate(path)]
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                for path in touched:
+                    self.touch(path, now)
+                self.collect(now)
+                self.settle_pending(now)
+                if self.ready and (len(self.ready) >= self.max_batch or now - self.ready_since >= self.batch_window):
+                    self.dispatch()
+                if self.manifest is not None and now - last_compact >= COMPACT_INTERVAL:
+                    self.manifest.save()
+                    last_compact = now
+                touched = watcher.poll(self.next_timeout())
+        finally:
+            watcher.close()
+            # 已经开始处理的图片处理完再退出，不留下写了一半的文件
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.collect(time.monotonic())
+            if self.manifest is not None:
+                self.manifest.save()
+
+    def next_timeout(self):
+        if self.pending or self.ready or self.in_flight:
+            return min(self.settle / 3, 0.05)
+        return 1.0
+
+    def touch(self, path, now):
+        if self.output_dir and os.path.abspath(path).startswith(os.path.abspath(self.output_dir) + os.sep):
+            return
+        if path in self.busy:
+            self.dirty.add(path)
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        entry = self.pending.get(path)
+        if entry is None:
+            self.pending[path] = [signature, now, now]
+        elif entry[0] != signature:
+            entry[0], entry[1] = signature, now
+
+    def settle_pending(self, now):
+        """大小和 mtime 持续 settle 秒不变（且不是空文件）的文件移入待处理批次"""
+        for path, entry in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if signature != entry[0]:
+                entry[0], entry[1] = signature, now
+            elif stat.st_size and now - entry[1] >= self.settle:
+                del self.pending[path]
+                if not self.ready:
+                    self.ready_since = now
+                self.ready.append((path, entry[2]))
+
+    def claim_output(self, path):
+        """登记 path 的输出文件名；已被另一个仍然存在的源文件占用时返回那个源文件"""
+        name = os.path.basename(output_path_for(path, ""))
+        source = source_key(path)
+        owner = self.output_owners.get(name)
+        if owner is not None and owner != source and os.path.exists(owner):
+            return owner
+        self.output_owners[name] = source
+        return None
+
+    def dispatch(self):
+        """把待处理批次按工作进程数切成几段提交；清单中已是最新的文件直接丢弃"""
+        batch, self.ready = self.ready, []
+        first_seen = dict(batch)
+        if self.manifest is not None:
+            todo, _ = self.manifest.plan(list(first_seen), self.settings_key)
+        else:
+            todo = [(path, None) for path in first_seen]
+        accepted = []
+        for path, digest in todo:
+            owner = self.claim_output(path)
+            if owner is None:
+                accepted.append((path, digest))
+            else:
+                self.report(failed_result(path, f"输出文件名与 {owner} 相同，为避免覆盖已跳过（请重命名）"),
+                            first_seen[path])
+        todo = accepted
+        if not todo:
+            return
+        size = -(-len(todo) // min(self.workers, len(todo)))
+        for start in range(0, len(todo), size):
+            items = todo[start:start + size]
+            try:
+                future = self.executor.submit(_export_batch, items, self.output_dir, self.settings)
+            except BrokenProcessPool:
+                self.restart_pool(self.executor)
+                future = self.executor.submit(_export_batch, items, self.output_dir, self.settings)
+            self.in_flight[future] = (self.executor, [(path, first_seen[path]) for path, _ in items])
+            self.busy.update(path for path, _ in items)
+
+    def report(self, result, first_seen):
+        result["latency"] = round(time.monotonic() - first_seen, 4)
+        if self.manifest is not None:
+            self.manifest.record(result, self.settings_key)
+        if self.on_result:
+            self.on_result(result)
+
+    def collect(self, now):
+        """处理已完成的批次；工作进程异常退出的批次换一个进程池重试"""
+        for future in [future for future in self.in_flight if future.done()]:
+            pool, items = self.in_flight.pop(future)
+            results = []
+            if not future.cancelled():
+                try:
+                    results = future.result()
+                except BrokenProcessPool as e:
+                    self.restart_pool(pool)
+                    results = self.retry_or_fail(items, e)
+                except Exception as e:
+                    results = [failed_result(path, str(e)) for path, _ in items]
+            for (path, first_seen), result in zip(items, results):
+                if result is not None:
+                    self.retries.pop(path, None)
+                    self.report(result, first_seen)
+            for path, _ in items:
+                self.busy.discard(path)
+                if path in self.dirty:
+                    self.dirty.discard(path)
+                    self.touch(path, now)
+
+    def retry_or_fail(self, items, error):
+        """工作进程异常退出的批次：没超过重试次数的图片放回待处理批次（返回 None），其余记为失败"""
+        results = []
+        now = time.monotonic()
+        for path, first_seen in items:
+            attempts = self.retries.get(path, 0)
+            if attempts < MAX_RETRIES and not self._stop.is_set():
+                self.retries[path] = attempts + 1
+                self.dirty.discard(path)  # 重试时读的已经是最新内容
+                if not self.ready:
+                    self.ready_since = now
+                self.ready.append((path, first_seen))
+                results.append(None)
+            else:
+                results.append(failed_result(path, f"工作进程异常退出（可能内存不足）: {error}"))
+        return results
+
+def failed_result(path, error):
+    return {"source": path, "output": None, "ok": False, "skipped": False, "error": error}
+
+
+def run_until_signalled(watcher):
+    """前台运行，收到 SIGTERM 或 Ctrl+C 时处理完在途的图片再退出"""
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    finally:
+        signal.signal(signal.SIGTERM, previous)